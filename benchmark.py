@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the OKPK pipeline on synthetic ontologies.
+
+Generates OWL ontologies of configurable size (classes, existential restrictions, annotations per class,
+object properties and role chains), runs ontology-kg-preprocessing-kit.py on them offline (sources are
+file:// URLs) and collects the time and memory of every pipeline step per scale point from the run report.
+Requires ROBOT on the PATH, like the pipeline itself.
+
+Example:
+    python benchmark.py --classes 1000,10000,100000 --variant native:export_engine=native,closure_index=true
+"""
+
+import os, sys, json, random, argparse, time, yaml
+from subprocess import check_call
+from xml.sax.saxutils import escape
+
+OBO = "http://purl.obolibrary.org/obo/"
+CLASS_PREFIX = "SYN"
+PROPERTY_PREFIX = "SYNR"
+CURIE_MAP = {
+    "SYN": OBO + "SYN_",
+    "SYNR": OBO + "SYNR_",
+    "IAO": OBO + "IAO_",
+    "oio": "http://www.geneontology.org/formats/oboInOwl#",
+}
+ANNOTATIONS = ["rdfs:label", "IAO:0000115", "oio:hasExactSynonym"]
+STEPS = ["download", "enrich", "count_properties", "reduce", "closure_index", "seed", "finish", "json",
+         "enrich_reduce_finish", "biolink_categories", "biolink", "kgx_native", "kgx_queries", "kgx_shards", "kgx_curies", "kgx_edges"]
+
+def term_id(prefix, i):
+    return "{}:{:07d}".format(prefix, i)
+
+def term_iri(prefix, i):
+    return "{}{}_{:07d}".format(OBO, prefix, i)
+
+def generate_synthetic_ontology(owl_file, classes, restrictions=2, annotations=3, properties=5, seed=42):
+    """
+    :param owl_file: Output RDF/XML file
+    :param classes: Number of classes. Class 1 is the root, every other class has a randomly chosen superclass
+    among the classes before it, which gives a tree of logarithmic depth.
+    :param restrictions: Number of 'property some filler' superclass expressions per class
+    :param annotations: Number of annotations per class: a label, a definition and then synonyms
+    :param properties: Number of object properties used in the restrictions
+    :param seed: Seed of the random generator, so that the same parameters give the same ontology
+    """
+    rng = random.Random(seed)
+    with open(owl_file, 'w') as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write('<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+                'xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#" '
+                'xmlns:owl="http://www.w3.org/2002/07/owl#" '
+                'xmlns:obo="{}" xmlns:oboInOwl="{}">\n'.format(OBO, CURIE_MAP["oio"]))
+        f.write('<owl:Ontology rdf:about="{}syn.owl"/>\n'.format(OBO))
+        for p in ["IAO_0000115"]:
+            f.write('<owl:AnnotationProperty rdf:about="{}{}"/>\n'.format(OBO, p))
+        f.write('<owl:AnnotationProperty rdf:about="{}hasExactSynonym"/>\n'.format(CURIE_MAP["oio"]))
+        for p in range(1, properties + 1):
+            f.write('<owl:ObjectProperty rdf:about="{}">\n'.format(term_iri(PROPERTY_PREFIX, p)))
+            f.write('  <rdfs:label>property {}</rdfs:label>\n'.format(p))
+            f.write('</owl:ObjectProperty>\n')
+        for c in range(1, classes + 1):
+            f.write('<owl:Class rdf:about="{}">\n'.format(term_iri(CLASS_PREFIX, c)))
+            if c > 1:
+                f.write('  <rdfs:subClassOf rdf:resource="{}"/>\n'.format(term_iri(CLASS_PREFIX, rng.randrange(1, c))))
+            for _ in range(restrictions if properties else 0):
+                f.write('  <rdfs:subClassOf><owl:Restriction>'
+                        '<owl:onProperty rdf:resource="{}"/><owl:someValuesFrom rdf:resource="{}"/>'
+                        '</owl:Restriction></rdfs:subClassOf>\n'.format(
+                            term_iri(PROPERTY_PREFIX, rng.randrange(1, properties + 1)),
+                            term_iri(CLASS_PREFIX, rng.randrange(1, classes + 1))))
+            for a in range(annotations):
+                if a == 0:
+                    f.write('  <rdfs:label>class {}</rdfs:label>\n'.format(c))
+                elif a == 1:
+                    f.write('  <obo:IAO_0000115>{}</obo:IAO_0000115>\n'.format(
+                        escape("Definition of class {} & its synthetic relatives.".format(c))))
+                else:
+                    f.write('  <oboInOwl:hasExactSynonym>synonym {} of class {}</oboInOwl:hasExactSynonym>\n'.format(a - 1, c))
+            f.write('</owl:Class>\n')
+        f.write('</rdf:RDF>\n')
+
+def benchmark_config(owl_file, properties=5, role_chains=1, overrides=None):
+    """
+    :return: Pipeline configuration for the synthetic ontology, keeping all object properties and adding
+    role_chains materialised chain properties, each defined by a chain of two of the object properties.
+    """
+    relations = [{"id": term_id(PROPERTY_PREFIX, p), "materialize": False} for p in range(1, properties + 1)]
+    for r in range(role_chains if properties else 0):
+        chain = "{}|{}".format(term_id(PROPERTY_PREFIX, r % properties + 1), term_id(PROPERTY_PREFIX, (r + 1) % properties + 1))
+        relations.append({"id": term_id(PROPERTY_PREFIX, properties + r + 1), "materialize": True, "chains": [chain]})
+    config = {
+        "robot_opts": "-v",
+        "clean": True,
+        "timeout_external_processes": "300m",
+        "download_cache": ".okpk-cache",
+        "run_report": True,
+        "curie_map": dict(CURIE_MAP),
+        "global": {"relations": [], "annotations": [{"id": a} for a in ANNOTATIONS]},
+        "ontologies": [{
+            "id": "syn",
+            "sources": ["file://" + os.path.abspath(owl_file)],
+            "roots": [{"id": term_id(CLASS_PREFIX, 1), "biolink": "biolink:NamedThing"}],
+            "relations": relations}],
+    }
+    config.update(overrides or {})
+    return config
+
+def parse_variant(variant):
+    """
+    :param variant: NAME or NAME:key=value,key=value with configuration overrides, like native:export_engine=native
+    """
+    name, _, settings = variant.partition(":")
+    overrides = dict()
+    for setting in [s for s in settings.split(",") if s]:
+        key, _, value = setting.partition("=")
+        overrides[key.strip()] = yaml.safe_load(value.strip())
+    return name, overrides
+
+def run_pipeline(driver, config, run_dir):
+    """
+    :return: Runs the pipeline with config in run_dir and returns the wall time and the run report.
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    config_file = os.path.join(run_dir, "okpk-benchmark-config.yaml")
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    env = dict(os.environ)
+    env["BUILDDIR"] = "build"
+    env.setdefault("SPARQLDIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sparql"))
+    for d in ["build", "ontologies"]:
+        os.makedirs(os.path.join(run_dir, d), exist_ok=True)
+    start = time.time()
+    with open(os.path.join(run_dir, "okpk.log"), 'w') as log:
+        check_call([sys.executable, os.path.abspath(driver), os.path.basename(config_file)], cwd=run_dir, env=env, stdout=log, stderr=log)
+    wall = time.time() - start
+    with open(os.path.join(run_dir, "build", "run_report.json"), 'r') as f:
+        report = json.load(f)
+    return wall, report
+
+def summarise(variant, classes, repeat, wall, report):
+    steps = dict()
+    for ontology in report["ontologies"]:
+        for step in ontology["steps"]:
+            steps[step["step"]] = {"wall_seconds": step["wall_seconds"], "cpu_seconds": step["cpu_seconds"],
+                                   "max_rss_bytes": step["max_rss_bytes"],
+                                   "output_bytes": sum(s or 0 for s in step.get("outputs", {}).values())}
+    return {"variant": variant, "classes": classes, "repeat": repeat, "wall_seconds": round(wall, 3),
+            "max_rss_bytes": max([s["max_rss_bytes"] or 0 for s in steps.values()] or [0]), "steps": steps}
+
+def print_table(results):
+    steps = [s for s in STEPS if any(s in r["steps"] for r in results)]
+    header = ["variant", "classes", "repeat"] + steps + ["total_s", "peak_rss_mb"]
+    rows = [header]
+    for r in results:
+        rows.append([r["variant"], str(r["classes"]), str(r["repeat"])] +
+                    ["{:.1f}".format(r["steps"][s]["wall_seconds"]) if s in r["steps"] else "-" for s in steps] +
+                    ["{:.1f}".format(r["wall_seconds"]), "{:.0f}".format(r["max_rss_bytes"] / 1024.0 ** 2)])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        print("  ".join(c.ljust(w) for c, w in zip(row, widths)).rstrip())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OKPK pipeline on synthetic ontologies.")
+    parser.add_argument("--classes", default="1000,10000", help="Comma separated scale points, in number of classes")
+    parser.add_argument("--restrictions", type=int, default=2, help="Existential restrictions per class")
+    parser.add_argument("--annotations", type=int, default=3, help="Annotations per class")
+    parser.add_argument("--properties", type=int, default=5, help="Number of object properties")
+    parser.add_argument("--role-chains", type=int, default=1, help="Number of materialised role chains")
+    parser.add_argument("--variant", action="append", help="NAME:key=value,... configuration overrides to compare, can be repeated (default: the default configuration)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scale point and variant")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for the ontology generator")
+    parser.add_argument("--workdir", default="benchmark", help="Directory for the generated ontologies and pipeline runs")
+    parser.add_argument("--output", default=None, help="Results file (default: WORKDIR/results.json)")
+    parser.add_argument("--driver", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ontology-kg-preprocessing-kit.py"), help="Pipeline script to benchmark")
+    args = parser.parse_args()
+
+    variants = [parse_variant(v) for v in (args.variant or ["default"])]
+    scales = [int(c) for c in args.classes.split(",")]
+    output = args.output or os.path.join(args.workdir, "results.json")
+    os.makedirs(args.workdir, exist_ok=True)
+    results = []
+    for classes in scales:
+        owl_file = os.path.join(args.workdir, "synthetic_{}_{}_{}_{}_{}.owl".format(classes, args.restrictions, args.annotations, args.properties, args.seed))
+        if not os.path.exists(owl_file):
+            print("Generating {} classes to {}".format(classes, owl_file))
+            generate_synthetic_ontology(owl_file, classes, args.restrictions, args.annotations, args.properties, args.seed)
+        for name, overrides in variants:
+            config = benchmark_config(owl_file, args.properties, args.role_chains, overrides)
+            for repeat in range(1, args.repeat + 1):
+                run_dir = os.path.join(args.workdir, name, str(classes))
+                print("Running {} on {} classes ({}/{})".format(name, classes, repeat, args.repeat))
+                wall, report = run_pipeline(args.driver, config, run_dir)
+                results.append(summarise(name, classes, repeat, wall, report))
+                with open(output, 'w') as f:
+                    json.dump({"parameters": vars(args), "results": results}, f, indent=2)
+    print_table(results)
+    print("Results written to {}".format(output))
+
+if __name__ == '__main__':
+    main()
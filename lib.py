@@ -1,18 +1,150 @@
 import os
 import pandas as pd
-from subprocess import check_call
+from subprocess import check_call, check_output, Popen, PIPE, CalledProcessError
 import urllib.request
+import urllib.error
+import urllib.parse
 import yaml
 import warnings
 import re
+import csv
 import shutil
+import hashlib
+import json
+import threading
+import asyncio
+import socket
+import time
+import atexit
+import gzip
+import sys
+import itertools
+import functools
+import multiprocessing
+import pickle
+import fcntl
+import resource
+from array import array
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+# Resolved configuration of a single ontology. Lists are tuples and maps are tuples of (key, value) pairs, so
+# that views are immutable and can be shared by all steps and worker processes.
+okpk_ontology_config = namedtuple("okpk_ontology_config", ["id", "sources", "roots", "properties",
+    "materialize_properties", "annotation_properties", "biolink_categories", "biolink_relations", "role_chains"])
 
 class okpk_config:
+    """
+    Pipeline configuration, parsed and validated once. The ontologies are resolved into okpk_ontology_config
+    views indexed by id, with the global settings (annotation properties, biolink relations) merged in, so that
+    the per ontology accessors are dictionary lookups.
+    """
     def __init__(self, config_file):
-        self.config = yaml.load(open(config_file, 'r'))
+        with open(config_file, 'r') as f:
+            self.config = yaml.safe_load(f) or dict()
+        self.validate()
+        self.config.setdefault("curie_map", dict())
+        self.ontologies = OrderedDict((t['id'], self.resolve_ontology(t)) for t in self.config.get("ontologies"))
+        self.curie_trie = None
+
+    def validate(self):
+        """
+        :return: Raises an exception that lists all problems of the configuration, before anything is run.
+        """
+        problems = []
+        if not isinstance(self.config.get("ontologies"), list) or not self.config.get("ontologies"):
+            problems.append("ontologies must be a non-empty list")
+        ids = set()
+        for i, t in enumerate(self.config.get("ontologies") or []):
+            if not isinstance(t, dict) or not t.get('id'):
+                problems.append("ontology {} has no id".format(i + 1))
+                continue
+            if t['id'] in ids:
+                problems.append("ontology {} is configured more than once".format(t['id']))
+            ids.add(t['id'])
+            if not isinstance(t.get('sources'), list) or not t.get('sources'):
+                problems.append("ontology {} must have a non-empty list of sources".format(t['id']))
+            for e in ['roots', 'relations']:
+                for r in t.get(e) or []:
+                    if not isinstance(r, dict) or not r.get('id'):
+                        problems.append("all {} of ontology {} must have an id".format(e, t['id']))
+            for r in t.get('relations') or []:
+                if isinstance(r, dict) and not isinstance(r.get('materialize', False), bool):
+                    problems.append("materialize of relation {} of ontology {} must be true or false".format(r.get('id'), t['id']))
+                if isinstance(r, dict) and not isinstance(r.get('chains') or [], list):
+                    problems.append("chains of relation {} of ontology {} must be a list".format(r.get('id'), t['id']))
+                    continue
+                for chain in (r.get('chains') or []) if isinstance(r, dict) else []:
+                    if not isinstance(chain, str) or "|" not in chain:
+                        problems.append("chain {} of relation {} of ontology {} must be properties separated by |".format(chain, r.get('id'), t['id']))
+        global_config = self.config.get("global") or dict()
+        for e in ['relations', 'annotations']:
+            for r in global_config.get(e) or []:
+                if not isinstance(r, dict) or not r.get('id'):
+                    problems.append("all global {} must have an id".format(e))
+        if not isinstance(self.config.get("curie_map") or dict(), dict):
+            problems.append("curie_map must be a map of prefixes to namespaces")
+        for key in ['step_timeouts', 'step_retries']:
+            if not isinstance(self.config.get(key) or dict(), dict):
+                problems.append("{} must be a map of step names to values".format(key))
+        step_timeouts = self.config.get("step_timeouts")
+        for step, timeout in (step_timeouts.items() if isinstance(step_timeouts, dict) else []):
+            try:
+                parse_duration(timeout)
+            except ValueError:
+                problems.append("timeout {} of step {} must be a duration like 90s, 60m or 5h".format(timeout, step))
+        for key in ['parallel_ontologies', 'parallel_steps', 'parallel_downloads', 'parallel_processes', 'export_shards']:
+            if key in self.config and (not isinstance(self.config[key], int) or self.config[key] < 1):
+                problems.append("{} must be a positive number".format(key))
+        if 'progress_interval' in self.config and (not isinstance(self.config['progress_interval'], (int, float)) or self.config['progress_interval'] < 0):
+            problems.append("progress_interval must be a number of seconds, or 0")
+        for key, values in [('export_engine', ['sparql', 'native']), ('intermediate_format', ['owl', 'ofn'])]:
+            if key in self.config and self.config[key] not in values:
+                problems.append("{} must be one of {}".format(key, ", ".join(values)))
+        for output in ['nodes', 'edges', 'annotations', 'json']:
+            try:
+                self.get_output_extension(output)
+            except Exception as e:
+                problems.append(str(e))
+        if problems:
+            raise Exception("Invalid configuration:\n  " + "\n  ".join(problems))
+
+    def resolve_ontology(self, t):
+        global_config = self.config.get("global") or dict()
+        relations = t.get('relations') or []
+        biolink_relations = OrderedDict((r['id'], r['biolink']) for r in global_config.get("relations") or [] if "biolink" in r)
+        biolink_relations.update((r['id'], r['biolink']) for r in relations if "biolink" in r)
+        return okpk_ontology_config(
+            id=t['id'],
+            sources=tuple(t['sources']),
+            roots=tuple(r['id'] for r in t.get('roots') or []) or ('owl:Thing',),
+            properties=tuple(r['id'] for r in relations),
+            materialize_properties=tuple(r['id'] for r in relations if r.get('materialize', False)),
+            annotation_properties=tuple(r['id'] for r in global_config.get("annotations") or []),
+            biolink_categories=tuple((r['id'], r['biolink']) for r in t.get('roots') or [] if "biolink" in r),
+            biolink_relations=tuple(biolink_relations.items()),
+            role_chains=tuple((r['id'], tuple(r.get('chains') or ())) for r in relations if r.get('chains')))
+
+    def get_ontology(self, id):
+        return self.ontologies[id]
 
     def get_curie_map(self):
         return self.config.get("curie_map")
+
+    def get_curie_trie(self):
+        """
+        :return: okpk_curie_trie of the curie_map, built once and shared, together with its cache of recently contracted IRIs.
+        """
+        if self.curie_trie is None:
+            self.curie_trie = okpk_curie_trie(self.get_curie_map())
+        return self.curie_trie
         
     def get_value_map(self,id,e0,e1,e2):
         map = dict()
@@ -25,21 +157,16 @@ class okpk_config:
         return map
     
     def get_biolink_relation_map(self,id):
-        relations = dict()
-        for t in self.config.get("global").get("relations"):
-            if "biolink" in t:
-                relations[t['id']] = r["biolink"]
-        relations.update(self.get_value_map(id,"ontologies","relations","biolink"))
-        return relations
+        return dict(self.ontologies[id].biolink_relations)
 
     def get_biolink_category_map(self,id):
-        return self.get_value_map(id,"ontologies","roots","biolink")
+        return dict(self.ontologies[id].biolink_categories)
         
     def get_role_chains(self, id):
-        return self.get_value_map(id,"ontologies","relations","chains")
+        return dict((r, list(chains)) for r, chains in self.ontologies[id].role_chains)
 
     def get_ontologies(self):
-        return [t['id'] for t in self.config.get("ontologies")]
+        return list(self.ontologies)
         
     def get_remove_disjoints(self):
         return self.config.get("remove_disjoints")
@@ -68,15 +195,7 @@ class okpk_config:
         return [t['prefix_iri'] for t in self.config.get("sources") if t['id'] == id][0]
 
     def get_roots(self, id):
-        roots = []
-        for t in self.config.get("ontologies"):
-            if (t['id'] == id) & ("roots" in t):
-                for root in t['roots']:
-                    roots.append(root['id'])
-        if roots:
-            return roots     
-        else:   
-            return ['owl:Thing']
+        return list(self.ontologies[id].roots)
 
     def is_clean_dir(self):
         return self.config.get("clean")
@@ -88,29 +207,18 @@ class okpk_config:
         return self.config.get("overwrite_ontologies")
 
     def get_ontology_properties(self, id, materialize_only=False):
-        props = []
-        for t in self.config.get("ontologies"):
-            if t['id'] == id:
-                if "relations" in t:
-                    for r in t.get("relations"):
-                        if materialize_only:
-                            if r['materialize'] == True:
-                                props.append(r['id'])
-                        else:
-                            props.append(r['id'])
-        return props
+        if materialize_only:
+            return list(self.ontologies[id].materialize_properties)
+        return list(self.ontologies[id].properties)
         
     def get_ontology_annotation_properties(self, id):
-        relations = []
-        for t in self.config.get("global").get("annotations"):
-            relations.append(t['id'])
-        return relations
+        return list(self.ontologies[id].annotation_properties)
 
     def get_external_timeout(self):
         return str(self.config.get("timeout_external_processes"))
 
     def get_global_properties(self):
-        return self.config.get("global").get("relations")
+        return (self.config.get("global") or dict()).get("relations") or []
 
     def get_working_directory(self):
         return self.config.get("working_directory")
@@ -119,7 +227,7 @@ class okpk_config:
         return self.config.get("robot_opts")
 
     def get_sources(self,id):
-        return [t['sources'] for t in self.config.get("ontologies") if t['id'] == id][0]
+        return list(self.ontologies[id].sources)
 
     def get_instantiate_superclasses_pattern_vars(self):
         return self.config.get("instantiate_superclasses_pattern_vars")
@@ -127,6 +235,1286 @@ class okpk_config:
     def get_robot_java_args(self):
         return self.config.get("robot_java_args")
 
+    def is_robot_heap_planner(self):
+        return self.config.get("robot_heap_planner", False)
+
+    def get_robot_min_heap(self):
+        return self.config.get("robot_min_heap", "1G")
+
+    def get_robot_max_heap(self):
+        return self.config.get("robot_max_heap")
+
+    def get_robot_heap_history(self):
+        return self.config.get("robot_heap_history")
+
+    def get_max_parallel_ontologies(self):
+        return int(self.config.get("parallel_ontologies", 1))
+
+    def get_robot_memory_budget(self):
+        return self.config.get("robot_memory_budget")
+
+    def get_max_parallel_steps(self):
+        return int(self.config.get("parallel_steps", 1))
+
+    def get_process_logs(self):
+        return self.config.get("process_logs")
+
+    def get_max_parallel_processes(self):
+        return self.config.get("parallel_processes")
+
+    def get_progress_interval(self):
+        return float(self.config.get("progress_interval", 60))
+
+    def get_robot_server(self):
+        return self.config.get("robot_server")
+
+    def is_sort_seed(self):
+        return self.config.get("sort_seed", False)
+
+    def is_dedupe_edges(self):
+        return self.config.get("dedupe_edges", False)
+
+    def is_closure_index(self):
+        return self.config.get("closure_index", False)
+
+    def get_export_engine(self):
+        return self.config.get("export_engine", "sparql")
+
+    def get_output_extension(self, output):
+        compression = self.config.get("compress_outputs")
+        if isinstance(compression, dict):
+            compression = compression.get(output)
+        if not compression or compression == "none":
+            return ""
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise Exception("Unknown compression {} of {} outputs, use gzip, zstd or none".format(compression, output))
+        return COMPRESSION_EXTENSIONS[compression]
+
+    def get_export_shards(self):
+        return int(self.config.get("export_shards", 1))
+
+    def get_download_cache(self):
+        return self.config.get("download_cache", ".okpk-cache")
+
+    def is_offline(self):
+        return self.config.get("offline", False)
+
+    def get_max_parallel_downloads(self):
+        return int(self.config.get("parallel_downloads", 4))
+
+    def is_fused_pipeline(self):
+        return self.config.get("fused_pipeline", False)
+
+    def is_keep_intermediates(self):
+        return self.config.get("keep_intermediates", False)
+
+    def get_intermediate_extension(self):
+        extension = "." + self.config.get("intermediate_format", "owl")
+        if self.config.get("compress_intermediates", False):
+            extension += ".gz"
+        return extension
+
+    def is_kgx_delta(self):
+        return self.config.get("kgx_delta", False)
+
+    def is_incremental(self):
+        return self.config.get("incremental", False)
+
+    def get_incremental_threshold(self):
+        return float(self.config.get("incremental_threshold", 0.1))
+
+    def get_step_cache(self):
+        return self.config.get("step_cache")
+
+    def is_run_report(self):
+        return self.config.get("run_report", True)
+
+    def get_step_timeout(self, step):
+        return (self.config.get("step_timeouts") or dict()).get(step)
+
+    def get_step_retries(self, step):
+        # Downloads fail for transient reasons, and resume where they stopped
+        return int((self.config.get("step_retries") or dict()).get(step, 2 if step == "download" else 0))
+
+    def get_retry_backoff(self):
+        return float(self.config.get("retry_backoff", 10))
+
+
+def parse_memory_size(size):
+    """
+    :param size: Memory size in Java notation, like 8G, 512m or 1024k. A plain number is interpreted as bytes.
+    :return: The size in bytes, or None if size is empty.
+    """
+    if not size:
+        return None
+    size = str(size).strip()
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    unit = size[-1].lower()
+    if unit in units:
+        return int(float(size[:-1]) * units[unit])
+    return int(size)
+
+def get_java_heap_size(java_args):
+    """
+    :param java_args: JVM arguments, like the ROBOT_JAVA_ARGS environment variable
+    :return: The maximum heap (-Xmx) in bytes, or None if no maximum heap is set.
+    """
+    heap = None
+    if java_args:
+        for arg in java_args.split():
+            if arg.startswith("-Xmx"):
+                heap = parse_memory_size(arg[4:])
+    return heap
+
+def plan_ontology_workers(max_workers, java_args=None, memory_budget=None, jvms_per_worker=1):
+    """
+    :param max_workers: Maximum number of workers (ontologies or steps) run at the same time
+    :param java_args: JVM arguments of a single ROBOT invocation (ROBOT_JAVA_ARGS)
+    :param memory_budget: Total memory all concurrent ROBOT invocations may reserve, like 32G
+    :param jvms_per_worker: Maximum number of ROBOT invocations a single worker runs at the same time
+    :return: The number of workers that can run concurrently without exceeding the memory budget.
+    """
+    workers = max(1, max_workers)
+    heap = get_java_heap_size(java_args)
+    budget = parse_memory_size(memory_budget)
+    if heap and budget:
+        workers = min(workers, max(1, budget // (heap * max(1, jvms_per_worker))))
+    return workers
+
+def run_ontologies_in_parallel(ontologies, process_ontology, max_workers=1, java_args=None, memory_budget=None, steps_per_ontology=1):
+    """
+    :param ontologies: List of ontology ids
+    :param process_ontology: Function that runs the pipeline for a single ontology id
+    :param max_workers: Maximum number of ontologies processed at the same time
+    :param java_args: JVM arguments of a single ROBOT invocation (ROBOT_JAVA_ARGS)
+    :param memory_budget: Total memory all concurrent ROBOT invocations may reserve, like 32G
+    :param steps_per_ontology: Maximum number of steps run at the same time for a single ontology
+    :return: Runs process_ontology for all ontologies on a pool of worker processes. Ontologies share no intermediate
+    files, so they can be processed independently. With a single worker, ontologies are processed in order in
+    the current process. A failed ontology does not stop the others, the run fails once all are processed.
+    """
+    steps = plan_ontology_workers(steps_per_ontology, java_args, memory_budget)
+    workers = plan_ontology_workers(min(max_workers, len(ontologies)), java_args, memory_budget, steps)
+    failed = []
+    if workers <= 1:
+        for o in ontologies:
+            try:
+                process_ontology(o)
+            except Exception as e:
+                print("Processing {} failed: {}".format(o, e))
+                failed.append(o)
+        if failed:
+            raise Exception("Processing of {} failed".format(", ".join(failed)))
+        return
+    print("Processing {} ontologies with {} parallel workers".format(len(ontologies), workers))
+    # process_ontology is a closure of the driver script, which has no main guard, so workers are forked
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {executor.submit(process_ontology, o): o for o in ontologies}
+        for future in as_completed(futures):
+            o = futures[future]
+            try:
+                future.result()
+                print("Finished processing {}".format(o))
+            except Exception as e:
+                print("Processing {} failed: {}".format(o, e))
+                failed.append(o)
+    if failed:
+        raise Exception("Processing of {} failed".format(", ".join(failed)))
+
+class okpk_step:
+    """
+    A single step of the pipeline: an action that reads the files in inputs and writes the files in outputs.
+    Steps that produce the inputs of another step are its dependencies. Steps with always_run are run even if
+    their outputs are up to date, for example to revalidate downloads. The outputs of cacheable steps are shared
+    through the okpk_step_cache, if one is configured. A step with a timeout (like 2h) cuts the timeout of every
+    external program it runs to what is left of it, and a failed step is retried up to retries times, waiting
+    retry_backoff seconds, doubled after every attempt.
+    """
+    def __init__(self, name, action, inputs=None, outputs=None, params=None, always_run=False, cacheable=False, timeout=None, retries=0, retry_backoff=10):
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs) if inputs else []
+        self.outputs = list(outputs) if outputs else []
+        self.params = params
+        self.always_run = always_run
+        self.cacheable = cacheable
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+class okpk_manifest:
+    """
+    Build manifest recording, for every step, a hash of its inputs (file contents, the configuration that
+    influences the step and the tool version) and of the outputs it produced. A step is only up to date if
+    neither its inputs nor its outputs changed since it was last run.
+    """
+    def __init__(self, manifest_file, tool_version=None):
+        self.manifest_file = manifest_file
+        self.tool_version = tool_version
+        self.lock = threading.Lock()
+        self.manifest = {"steps": {}, "files": {}}
+        if os.path.exists(manifest_file):
+            try:
+                with open(manifest_file, 'r') as f:
+                    self.manifest = json.load(f)
+            except ValueError:
+                print("Ignoring unreadable build manifest " + manifest_file)
+
+    def file_hash(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        key = "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            cached = self.manifest["files"].get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        file_hash = hash_file(path)
+        with self.lock:
+            self.manifest["files"][path] = [key, file_hash]
+        return file_hash
+
+    def step_signature(self, step):
+        signature = hashlib.sha256()
+        signature.update(json.dumps([step.name, self.tool_version, step.params], sort_keys=True, default=str).encode('utf-8'))
+        for i in step.inputs:
+            signature.update("{}={}".format(i, self.file_hash(i)).encode('utf-8'))
+        return signature.hexdigest()
+
+    def is_up_to_date(self, step):
+        with self.lock:
+            recorded = self.manifest["steps"].get(step.name)
+        if not recorded or recorded.get("signature") != self.step_signature(step):
+            return False
+        for output in step.outputs:
+            if self.file_hash(output) is None or self.file_hash(output) != recorded["outputs"].get(output):
+                return False
+        return True
+
+    def record(self, step):
+        outputs = dict((output, self.file_hash(output)) for output in step.outputs)
+        signature = self.step_signature(step)
+        with self.lock:
+            self.manifest["steps"][step.name] = {"signature": signature, "outputs": outputs}
+            self.save()
+
+    def save(self):
+        tmp = self.manifest_file + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.manifest_file)
+
+class okpk_step_cache:
+    """
+    Store of step outputs shared by all ontologies and runs. Entries are keyed by the step name, its parameters,
+    the tool version and the contents (not the paths) of its inputs, so a step whose inputs were already
+    processed, for another ontology or in an earlier run, gets its outputs from the cache instead of running.
+    Concurrent workers computing the same entry wait for each other through a lock file per entry.
+    """
+    def __init__(self, cache_dir, tool_version=None):
+        self.cache_dir = cache_dir
+        self.tool_version = tool_version
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, step, manifest=None):
+        inputs = [manifest.file_hash(i) if manifest is not None else hash_file(i) for i in step.inputs]
+        # Outputs are restored by position, so steps with optional outputs (like the intermediates of the fused
+        # pipeline) must not share entries between their variants
+        return hashlib.sha256(json.dumps([step.name, self.tool_version, step.params, inputs, len(step.outputs)], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def run(self, step, manifest=None, label=""):
+        """
+        :return: Restores the outputs of step from the cache or, if there is no entry for its inputs yet, runs
+        step and stores its outputs.
+        """
+        entry = os.path.join(self.cache_dir, self.key(step, manifest))
+        with open(entry + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.restore(entry, step.outputs):
+                print("{} Restored {} from the step cache.".format(label, step.name).strip())
+                return
+            # Outputs may be links to cache entries, which must not be overwritten in place
+            for output in step.outputs:
+                if os.path.exists(output):
+                    os.remove(output)
+            step.action()
+            self.store(entry, step.outputs)
+
+    def restore(self, entry, outputs):
+        """
+        :return: Links the outputs to the files of entry. Returns False, without changing any output, if there is
+        no complete entry with the same number of outputs.
+        """
+        try:
+            with open(os.path.join(entry, "outputs.json"), 'r') as f:
+                cached_outputs = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if len(cached_outputs) != len(outputs) or not all(os.path.exists(os.path.join(entry, str(i))) for i in range(len(outputs))):
+            return False
+        for i, output in enumerate(outputs):
+            cached = os.path.join(entry, str(i))
+            if not (os.path.exists(output) and os.path.samefile(cached, output)):
+                link_or_copy(cached, output)
+        return True
+
+    def store(self, entry, outputs):
+        tmp = "{}.tmp{}".format(entry, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for i, output in enumerate(outputs):
+            link_or_copy(output, os.path.join(tmp, str(i)))
+        with open(os.path.join(tmp, "outputs.json"), 'w') as f:
+            json.dump([os.path.basename(output) for output in outputs], f)
+        # An incomplete entry, which restore treats as a miss, is replaced
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+
+def link_or_copy(source, target):
+    """
+    :return: Hardlinks (or, across file systems, copies) source to target, replacing target.
+    """
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        with atomic_output(target) as tmp:
+            shutil.copyfile(source, tmp)
+
+def hash_file(path, block_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+_profile_context = threading.local()
+# Ontology, step and deadline (time.time(), if it has a timeout) of the step running in the current thread
+_step_context = threading.local()
+
+def parse_duration(duration):
+    """
+    :param duration: Duration in the notation of the timeout program, like 90s, 60m, 5h or 1d. A plain number is
+    interpreted as seconds.
+    :return: The duration in seconds.
+    """
+    duration = str(duration).strip()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if duration[-1:].lower() in units:
+        return float(duration[:-1]) * units[duration[-1].lower()]
+    return float(duration)
+
+@contextmanager
+def atomic_output(path):
+    """
+    :return: Context that yields a temporary path next to path, which is renamed to path only if the block
+    completes. A step that is killed or fails never leaves a partially written path behind.
+    """
+    tmp = get_tmp_path(path)
+    try:
+        yield tmp
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+
+def get_process_tree_rss(pid):
+    """
+    :return: Resident memory in bytes of the process pid and all its descendants, like the JVM started by the robot
+    script under timeout, read from /proc. None if it is not available.
+    """
+    children = dict()
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(os.path.join('/proc', entry, 'stat'), 'r') as f:
+                    # The command name in parentheses may contain spaces, the parent pid is the second field after it
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    except OSError:
+        return None
+    rss = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        try:
+            with open('/proc/{}/statm'.format(p), 'r') as f:
+                rss += int(f.read().split()[1]) * resource.getpagesize()
+        except (OSError, IndexError, ValueError):
+            pass
+        todo.extend(children.get(p, []))
+    return rss
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(seconds // 3600, seconds // 60 % 60)
+    return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+
+class okpk_process_manager:
+    """
+    Runs external programs as coroutines on an asyncio event loop in a background thread, so that the threads
+    running the steps only wait for their results. The standard output and error of every program are streamed
+    line by line, tagged with the ontology and step that ran it, either to the console or, with a log_dir, to a
+    log file per ontology and step (LOG_DIR/ONTOLOGY/STEP.log). At most max_processes programs run at the same
+    time, and every progress_interval seconds the running programs are listed with their elapsed time and
+    resident memory.
+    """
+    FAILURE_LINES = 20
+
+    def __init__(self, log_dir=None, max_processes=None, progress_interval=60):
+        self.log_dir = log_dir
+        self.max_processes = max_processes
+        self.progress_interval = progress_interval
+        self.running = dict()
+        self.pid = None
+        self.loop = None
+        self.lock = threading.Lock()
+        # A fork can happen while another thread holds the lock, the child starts with a fresh one
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Threads do not survive a fork, so every worker process starts its own event loop
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.running = dict()
+            self.limit = None
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                self.limit = asyncio.Semaphore(self.max_processes) if self.max_processes else None
+                if self.progress_interval:
+                    loop.create_task(self._report_progress())
+                loop.call_soon(ready.set)
+                loop.run_forever()
+            threading.Thread(target=run_loop, name="okpk-process-manager", daemon=True).start()
+            ready.wait()
+            # Other threads only see the loop once it is running
+            self.loop = loop
+            self.pid = os.getpid()
+
+    def run(self, cmd, env=None, ontology=None, step=None):
+        """
+        :return: Runs cmd and returns its exit status, resource usage (as os.wait4) and wall time. Blocks the
+        calling thread only; if it is interrupted, the program is killed.
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self.run_process(cmd, env, ontology or "okpk", step or "external"), self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def get_log_file(self, ontology, step):
+        return os.path.join(self.log_dir, ontology, "{}.log".format(step)) if self.log_dir else None
+
+    async def run_process(self, cmd, env, ontology, step):
+        if self.limit is not None:
+            async with self.limit:
+                return await self._run_process(cmd, env, ontology, step)
+        return await self._run_process(cmd, env, ontology, step)
+
+    async def _run_process(self, cmd, env, ontology, step):
+        log_file = self.get_log_file(ontology, step)
+        log = None
+        if log_file:
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+            log = open(log_file, 'a')
+            log.write("{} $ {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), " ".join(cmd)))
+        tail = []
+        tag = "[{}/{}]".format(ontology, step)
+        def write(stream, line):
+            if log is not None:
+                log.write("{} {} {}\n".format(time.strftime("%H:%M:%S"), stream, line))
+            else:
+                print("{} {}".format(tag, line), flush=True)
+            tail.append(line)
+            del tail[:-self.FAILURE_LINES]
+        start = time.time()
+        process = Popen(cmd, env=env, stdout=PIPE, stderr=PIPE)
+        # Processes are reaped by os.wait4 in a thread rather than by asyncio, to keep their resource usage
+        waited = self.loop.create_future()
+        def wait_process():
+            try:
+                result = os.wait4(process.pid, 0)
+                self.loop.call_soon_threadsafe(lambda: waited.done() or waited.set_result(result))
+            except BaseException as e:
+                self.loop.call_soon_threadsafe(lambda e=e: waited.done() or waited.set_exception(e))
+        threading.Thread(target=wait_process, daemon=True).start()
+        self.running[process.pid] = {"ontology": ontology, "step": step, "command": cmd, "pid": process.pid, "started": start}
+        try:
+            await asyncio.gather(self._stream(process.stdout, "stdout", write), self._stream(process.stderr, "stderr", write))
+            _, status, usage = await waited
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            del self.running[process.pid]
+            process.stdout.close()
+            process.stderr.close()
+            if log is not None:
+                log.close()
+        returncode = os.waitstatus_to_exitcode(status)
+        if returncode != 0 and log is not None:
+            for line in tail:
+                print("{} {}".format(tag, line))
+            print("{} Exit status {}, see {}".format(tag, returncode, log_file))
+        return returncode, usage, time.time() - start
+
+    async def _stream(self, pipe, stream, write):
+        reader = asyncio.StreamReader(limit=1024 * 1024)
+        transport, _ = await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # A line longer than the limit is written in parts
+                    line = await reader.read(1024 * 1024)
+                if not line:
+                    return
+                write(stream, line.decode('utf-8', errors='replace').rstrip('\n'))
+        finally:
+            transport.close()
+
+    def progress(self):
+        """
+        :return: The programs running in this process: their ontology, step, command, pid, elapsed seconds and
+        resident memory in bytes (of the program and its descendants).
+        """
+        now = time.time()
+        return [dict(p, elapsed_seconds=round(now - p["started"], 1), rss_bytes=get_process_tree_rss(p["pid"]))
+                for p in sorted(list(self.running.values()), key=lambda p: p["started"])]
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            running = self.progress()
+            if running:
+                print("Running: " + ", ".join("{}/{} {} {}".format(p["ontology"], p["step"], format_duration(p["elapsed_seconds"]),
+                    format_size(p["rss_bytes"])) for p in running), flush=True)
+
+PROCESS_MANAGER = okpk_process_manager(progress_interval=0)
+
+def start_process_manager(log_dir=None, max_processes=None, progress_interval=60):
+    """
+    :return: Configures the okpk_process_manager all external programs are run by.
+    """
+    global PROCESS_MANAGER
+    PROCESS_MANAGER = okpk_process_manager(log_dir, max_processes, progress_interval)
+    return PROCESS_MANAGER
+
+def get_process_progress():
+    return PROCESS_MANAGER.progress()
+
+def run_external(cmd, env=None):
+    """
+    :param cmd: Command line of an external program, like ROBOT or dosdp-tools
+    :param env: Optional environment of the program, like os.environ with ROBOT_JAVA_ARGS set
+    :return: Runs cmd like check_call, through the PROCESS_MANAGER, and returns its resource usage. If called from
+    a step run by an okpk_profiler, the wall time, CPU time, peak resident memory (of the process and the processes it waited for,
+    like the JVM started by the robot script) and exit status of the call are recorded with the step.
+    """
+    deadline = getattr(_step_context, "deadline", None)
+    if deadline is not None and len(cmd) > 1 and cmd[0] == 'timeout':
+        # The external timeout is cut to what is left of the timeout of the step
+        remaining = max(1, int(deadline - time.time()))
+        if parse_duration(cmd[1]) > remaining:
+            cmd = ['timeout', '{}s'.format(remaining)] + cmd[2:]
+    returncode, usage, wall = PROCESS_MANAGER.run(cmd, env, getattr(_step_context, "ontology", None), getattr(_step_context, "step", None))
+    record = getattr(_profile_context, "record", None)
+    if record is not None:
+        record["calls"].append({
+            "command": cmd,
+            "wall_seconds": round(wall, 3),
+            "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+            "max_rss_bytes": usage.ru_maxrss * 1024,
+            "exit_status": returncode})
+    if returncode != 0:
+        if cmd[0] == 'timeout' and returncode == 124:
+            print("Timed out after {}: {}".format(cmd[1], " ".join(cmd[2:])))
+        raise CalledProcessError(returncode, cmd)
+    return usage
+
+def get_file_sizes(paths):
+    return dict((path, os.path.getsize(path) if os.path.exists(path) else None) for path in paths)
+
+class okpk_profiler:
+    """
+    Collects, for every step of a single ontology, its wall time, CPU time (of the step itself and of all
+    external programs it ran), peak resident memory, the sizes of its input and output files and its status.
+    """
+    def __init__(self, ontology):
+        self.ontology = ontology
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.steps = []
+
+    def skip(self, step):
+        with self.lock:
+            self.steps.append({"ontology": self.ontology, "step": step.name, "status": "skipped",
+                "started": time.time(), "wall_seconds": 0, "cpu_seconds": 0, "max_rss_bytes": None,
+                "inputs": get_file_sizes(step.inputs), "outputs": get_file_sizes(step.outputs), "calls": []})
+
+    def run(self, step, action=None):
+        record = {"ontology": self.ontology, "step": step.name, "status": "failed", "started": time.time(),
+            "inputs": get_file_sizes(step.inputs), "calls": []}
+        cpu = time.thread_time()
+        _profile_context.record = record
+        try:
+            (action or step.action)()
+            record["status"] = "ok"
+        finally:
+            _profile_context.record = None
+            calls = record["calls"]
+            record["wall_seconds"] = round(time.time() - record["started"], 3)
+            record["cpu_seconds"] = round(time.thread_time() - cpu + sum(c["cpu_seconds"] for c in calls), 3)
+            record["max_rss_bytes"] = max([c["max_rss_bytes"] for c in calls] or [None], key=lambda x: x or 0)
+            record["outputs"] = get_file_sizes(step.outputs)
+            with self.lock:
+                self.steps.append(record)
+
+    def report(self):
+        with self.lock:
+            steps = sorted(self.steps, key=lambda s: s["started"])
+        return {"ontology": self.ontology, "started": self.started,
+            "wall_seconds": round(time.time() - self.started, 3), "steps": steps}
+
+    def save(self, report_file):
+        tmp = report_file + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp, report_file)
+
+def format_size(size):
+    if size is None:
+        return "-"
+    for unit in ['B', 'K', 'M', 'G']:
+        if size < 1024:
+            return "{:.0f}{}".format(size, unit) if unit == 'B' else "{:.1f}{}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f}T".format(size)
+
+def write_run_report(report_files, report_json, report_table, since=None):
+    """
+    :param report_files: Per ontology reports written by okpk_profiler.save
+    :param report_json: Output file for the combined report
+    :param report_table: Output file for the summary table
+    :param since: If given, per ontology reports started before this time (left over from earlier runs) are ignored
+    :return: Combines the per ontology reports into a single JSON report and a summary table with one row per
+    step, and prints the table.
+    """
+    reports = []
+    for report_file in report_files:
+        if os.path.exists(report_file):
+            with open(report_file, 'r') as f:
+                report = json.load(f)
+            if since is None or report["started"] >= since:
+                reports.append(report)
+    with open(report_json, 'w') as f:
+        json.dump({"ontologies": reports}, f, indent=2)
+    header = ["ontology", "step", "status", "wall_s", "cpu_s", "peak_rss", "input", "output", "calls"]
+    rows = []
+    for report in reports:
+        for step in report["steps"]:
+            rows.append([report["ontology"], step["step"], step["status"], "{:.1f}".format(step["wall_seconds"]),
+                "{:.1f}".format(step["cpu_seconds"]), format_size(step["max_rss_bytes"]),
+                format_size(sum(s or 0 for s in step["inputs"].values())),
+                format_size(sum(s or 0 for s in step.get("outputs", {}).values())), str(len(step["calls"]))])
+        rows.append([report["ontology"], "total", "", "{:.1f}".format(report["wall_seconds"]),
+            "{:.1f}".format(sum(s["cpu_seconds"] for s in report["steps"])),
+            format_size(max([s["max_rss_bytes"] or 0 for s in report["steps"]] or [0])), "", "",
+            str(sum(len(s["calls"]) for s in report["steps"]))])
+    widths = [max(len(r[i]) for r in [header] + rows) for i in range(len(header))]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(r, widths)).rstrip() for r in [header] + rows]
+    with open(report_table, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n".join(lines))
+
+class okpk_robot_server:
+    """
+    A long-lived ROBOT JVM, run as a Nailgun server. ROBOT commands are sent to it with the ng client, which
+    saves the JVM startup and class loading of every ROBOT invocation. The server resolves relative paths
+    against the directory it was started in, so it has to be started in the working directory of the pipeline.
+    """
+    def __init__(self, classpath, port=2113, java_args=None, main_class="com.facebook.nailgun.NGServer", ng="ng", startup_timeout=60):
+        self.classpath = classpath
+        self.port = int(port)
+        self.java_args = java_args
+        self.main_class = main_class
+        self.ng = ng
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.timed_out = False
+
+    def start(self):
+        if not shutil.which(self.ng) or not shutil.which("java"):
+            print("Can not start ROBOT server: {} or java not found.".format(self.ng))
+            return False
+        cmd = ['java']
+        if self.java_args:
+            cmd.extend(self.java_args.split())
+        cmd.extend(['-cp', self.classpath, self.main_class, '127.0.0.1:{}'.format(self.port)])
+        print("Starting ROBOT server: " + " ".join(cmd))
+        self.process = Popen(cmd)
+        atexit.register(self.stop)
+        started = time.time()
+        while time.time() - started < self.startup_timeout:
+            if self.process.poll() is not None:
+                print("ROBOT server exited with code {}".format(self.process.returncode))
+                return False
+            if self.is_running():
+                return True
+            time.sleep(0.5)
+        print("ROBOT server did not start within {} seconds".format(self.startup_timeout))
+        self.stop()
+        return False
+
+    def is_running(self):
+        try:
+            with socket.create_connection(('127.0.0.1', self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                check_call(self.command()[:-1] + ['ng-stop'])
+                self.process.wait(timeout=30)
+            except Exception:
+                self.process.kill()
+        self.process = None
+
+    def command(self):
+        return [self.ng, '--nailgun-port', str(self.port), 'org.obolibrary.robot.CommandLineInterface']
+
+ROBOT_SERVER = None
+
+def start_robot_server(classpath, port=2113, java_args=None, main_class="com.facebook.nailgun.NGServer"):
+    """
+    :param classpath: Java classpath containing ROBOT and the Nailgun server, like /tools/robot.jar:/tools/nailgun-server.jar
+    :param port: Local port the server listens on
+    :param java_args: JVM arguments of the server, like ROBOT_JAVA_ARGS
+    :param main_class: Main class of the Nailgun server
+    :return: Starts a long-lived ROBOT server that all ROBOT helpers are routed to. If the server can not be
+    started, or stops responding, every ROBOT helper falls back to running its own ROBOT process.
+    """
+    global ROBOT_SERVER
+    server = okpk_robot_server(classpath, port, java_args, main_class)
+    if server.start():
+        ROBOT_SERVER = server
+    else:
+        print("Falling back to running a separate ROBOT process for every step.")
+
+def use_robot_server():
+    """
+    :return: True if ROBOT commands are sent to the ROBOT server. A timeout only stops the ng client, the command
+    keeps running in the server, so steps with a step timeout and, with the heap planner, all steps run their own
+    ROBOT process. After a command in the server timed out, the server is no longer used.
+    """
+    if ROBOT_SERVER is None or ROBOT_SERVER.timed_out or HEAP_PLANNER is not None:
+        return False
+    return getattr(_step_context, "deadline", None) is None and ROBOT_SERVER.is_running()
+
+def get_robot_command(server=None):
+    if use_robot_server() if server is None else server:
+        return ROBOT_SERVER.command()
+    return ['robot']
+
+def robot_call(args, TIMEOUT="60m"):
+    """
+    :param args: ROBOT arguments, a single command or a chain
+    :return: Runs ROBOT with args. All outputs (-o, --output and the results of --query) are written to temporary
+    paths, with the same extension, and renamed once ROBOT succeeded, so a failed or killed invocation never
+    leaves a partial output behind. Later references to an output in the same chain, like a term file written
+    by a query, are redirected to the temporary path.
+    """
+    tmp = dict()
+    atomic_args = []
+    for i, arg in enumerate(args):
+        if (i > 0 and args[i - 1] in ('-o', '--output')) or (i > 1 and args[i - 2] == '--query'):
+            tmp[arg] = get_tmp_path(arg)
+        atomic_args.append(tmp.get(arg, arg))
+    server = use_robot_server()
+    cmd = ['timeout', TIMEOUT] + get_robot_command(server) + atomic_args
+    try:
+        if server:
+            # The heap of the shared server JVM is fixed when it is started
+            run_external(cmd)
+        else:
+            run_jvm(cmd, get_robot_inputs(args), get_robot_command_kind(args))
+    except BaseException as e:
+        if server and isinstance(e, CalledProcessError) and e.returncode == 124:
+            print("A ROBOT command timed out, but may still be running in the ROBOT server. Later ROBOT commands run their own process.")
+            ROBOT_SERVER.timed_out = True
+        for path in tmp.values():
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    for output, path in tmp.items():
+        if os.path.exists(path):
+            os.replace(path, output)
+
+def get_robot_version():
+    try:
+        return check_output(get_robot_command() + ['--version']).decode('utf-8').strip()
+    except Exception as e:
+        print("Could not determine ROBOT version: {}".format(e))
+        return None
+
+ROBOT_REASONING_COMMANDS = set(['reason', 'materialize', 'relax', 'reduce', 'explain'])
+ROBOT_QUERY_COMMANDS = set(['query', 'update', 'verify', 'report'])
+
+def get_robot_command_kind(args):
+    """
+    :param args: ROBOT arguments, a single command or a chain
+    :return: reason if the chain runs a reasoner, query if it runs SPARQL queries and convert otherwise (merge,
+    convert, extract, filter, remove and the like), which is the order of their memory requirements.
+    """
+    if any(arg in ROBOT_REASONING_COMMANDS for arg in args):
+        return "reason"
+    if any(arg in ROBOT_QUERY_COMMANDS for arg in args):
+        return "query"
+    return "convert"
+
+def get_robot_inputs(args):
+    return [args[i + 1] for i, arg in enumerate(args[:-1]) if arg in ('-i', '--input')]
+
+class okpk_memory_budget:
+    """
+    Memory budget shared by all processes of a run through a lock file: every JVM reserves its heap before it is
+    started and releases it when it exits, and waits while the reservations of the other JVMs leave too little
+    of the budget. Reservations of processes that died are dropped. A JVM whose heap exceeds the budget on its
+    own is started once no other JVM holds a reservation.
+    """
+    def __init__(self, budget, state_file, poll_seconds=0.5):
+        self.budget = budget
+        self.state_file = state_file
+        self.poll_seconds = poll_seconds
+
+    def _update(self, change):
+        with open(self.state_file + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            reservations = dict()
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r') as f:
+                    reservations = json.load(f)
+            for token in list(reservations):
+                try:
+                    os.kill(int(token.split(":")[0]), 0)
+                except (OSError, ValueError):
+                    # Gone, or a recycled pid of another user (PermissionError)
+                    del reservations[token]
+            result = change(reservations)
+            with open(self.state_file, 'w') as f:
+                json.dump(reservations, f)
+            return result
+
+    def acquire(self, size):
+        token = "{}:{}".format(os.getpid(), threading.get_ident())
+
+        def reserve(reservations):
+            reserved = sum(reservations.values())
+            if not reservations or reserved + size <= self.budget:
+                reservations[token] = size
+                return True
+            return False
+
+        while not self._update(reserve):
+            time.sleep(self.poll_seconds)
+        return token
+
+    def release(self, token):
+        self._update(lambda reservations: reservations.pop(token, None))
+
+class okpk_heap_planner:
+    """
+    Chooses the heap (-Xmx) of every ROBOT and dosdp-tools invocation instead of a single global
+    ROBOT_JAVA_ARGS. The first estimate scales with the size of the inputs, by a factor that depends on the kind
+    of command (reasoning needs more memory per input byte than SPARQL queries, which need more than
+    conversions). Once an invocation with the same kind and inputs (by file name) has run, the heap it used per
+    input byte (its peak memory minus the JVM overhead, at most the heap it was given) is used instead, so later
+    runs size the heap from what was actually needed. A JVM that used up its whole heap may have needed less, so
+    it records the heap it was given without the headroom, and the headroom does not compound across runs. A heap
+    that ran out of memory is remembered and not planned again for inputs of the same size. JVMs are
+    started with -XX:+ExitOnOutOfMemoryError, and an invocation that runs out of memory is retried with twice the
+    heap, up to max_heap. With a memory budget, concurrent invocations wait until their heap fits.
+    """
+    KIND_FACTORS = {"reason": 10.0, "query": 6.0, "convert": 4.0}
+    JVM_BASE = 512 * 1024 ** 2
+    GZIP_RATIO = 8
+    OUT_OF_MEMORY_EXIT = 3
+
+    def __init__(self, history_file, java_args=None, min_heap="1G", max_heap=None, budget=None, headroom=1.25):
+        """
+        :param history_file: JSON file with the measured peaks of previous runs, shared by all processes
+        :param java_args: Other JVM arguments of every invocation; -Xmx in java_args is the default max_heap
+        :param min_heap: Smallest heap, like 1G
+        :param max_heap: Largest heap, like 32G (default: the memory budget)
+        :param budget: Optional okpk_memory_budget shared by all concurrent invocations
+        :param headroom: Factor applied to the learned heap
+        """
+        args = (java_args or "").split()
+        self.java_args = [arg for arg in args if not arg.startswith("-Xmx")]
+        self.min_heap = parse_memory_size(min_heap) or 0
+        self.max_heap = parse_memory_size(max_heap) or get_java_heap_size(java_args) or (budget.budget if budget else None)
+        self.budget = budget
+        self.history_file = history_file
+        self.headroom = headroom
+
+    def key(self, kind, inputs):
+        return kind + ":" + "+".join(sorted(os.path.basename(i) for i in inputs))
+
+    def input_size(self, inputs):
+        size = 0
+        for i in inputs:
+            if os.path.exists(i):
+                size += os.path.getsize(i) * (self.GZIP_RATIO if i.endswith(".gz") else 1)
+        return size
+
+    def load_history(self):
+        if not os.path.exists(self.history_file):
+            return dict()
+        with open(self.history_file, 'r') as f:
+            return json.load(f)
+
+    def estimate(self, kind, inputs):
+        """
+        :return: The heap in bytes for an invocation of the given kind on inputs, rounded up to 256M.
+        """
+        size = self.input_size(inputs)
+        learned = self.load_history().get(self.key(kind, inputs))
+        if learned and "heap_bytes" in learned and learned["input_bytes"]:
+            heap = learned["heap_bytes"] * self.headroom * max(1.0, size / float(learned["input_bytes"]))
+            # Never plan a heap that already ran out of memory on inputs of the same size
+            if size >= learned["input_bytes"]:
+                heap = max(heap, learned.get("failed_heap_bytes", 0) + 1)
+        else:
+            heap = self.JVM_BASE + self.KIND_FACTORS.get(kind, self.KIND_FACTORS["reason"]) * size
+        return self.clamp(heap)
+
+    def clamp(self, heap):
+        heap = max(self.min_heap, int(heap))
+        if self.max_heap:
+            heap = min(heap, self.max_heap)
+        block = 256 * 1024 ** 2
+        return -(-heap // block) * block
+
+    def record(self, kind, inputs, heap_bytes, failed_heap_bytes=0):
+        """
+        :param heap_bytes: Heap the invocation needs, without headroom
+        :param failed_heap_bytes: Heap the invocation ran out of memory with, the largest one is kept
+        """
+        key = self.key(kind, inputs)
+        with open(self.history_file + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            history = self.load_history()
+            size = self.input_size(inputs)
+            previous = history.get(key) or dict()
+            if previous.get("input_bytes") == size:
+                failed_heap_bytes = max(failed_heap_bytes, previous.get("failed_heap_bytes", 0))
+            history[key] = {"input_bytes": size, "heap_bytes": int(heap_bytes), "failed_heap_bytes": int(failed_heap_bytes)}
+            tmp = self.history_file + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(history, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.history_file)
+
+    def run(self, cmd, inputs, kind, java_args_variable='ROBOT_JAVA_ARGS'):
+        """
+        :param cmd: Command line of the invocation
+        :param inputs: Input files of the invocation
+        :param kind: reason, query or convert
+        :param java_args_variable: Environment variable the JVM arguments are passed in: ROBOT_JAVA_ARGS for
+        ROBOT, JAVA_OPTS for dosdp-tools
+        """
+        heap = self.estimate(kind, inputs)
+        out_of_memory = False
+        while True:
+            env = dict(os.environ)
+            env[java_args_variable] = " ".join(self.java_args + ["-Xmx{}m".format(heap // 1024 ** 2), "-XX:+ExitOnOutOfMemoryError"])
+            token = self.budget.acquire(heap) if self.budget else None
+            try:
+                usage = run_external(cmd, env)
+            except CalledProcessError as e:
+                if e.returncode != self.OUT_OF_MEMORY_EXIT or (self.max_heap and heap >= self.max_heap):
+                    raise
+                print("Out of memory with a heap of {}, retrying with {}.".format(format_size(heap), format_size(self.clamp(heap * 2))))
+                self.record(kind, inputs, self.clamp(heap * 2) / self.headroom, heap)
+                heap = self.clamp(heap * 2)
+                out_of_memory = True
+                continue
+            finally:
+                if token is not None:
+                    self.budget.release(token)
+            # The resident memory includes the JVM itself, and a JVM grows its heap up to -Xmx before it collects
+            used = max(0, usage.ru_maxrss * 1024 - self.JVM_BASE)
+            if not out_of_memory:
+                self.record(kind, inputs, min(used, heap / self.headroom))
+            return
+
+HEAP_PLANNER = None
+
+def start_heap_planner(history_file, java_args=None, min_heap="1G", max_heap=None, memory_budget=None, budget_file=None):
+    """
+    :return: Routes all ROBOT (outside of a ROBOT server) and dosdp-tools invocations through an okpk_heap_planner.
+    With a memory_budget, the reservations are shared by all processes through budget_file.
+    """
+    global HEAP_PLANNER
+    budget = okpk_memory_budget(parse_memory_size(memory_budget), budget_file) if memory_budget and budget_file else None
+    if budget is not None and os.path.exists(budget_file):
+        os.remove(budget_file)
+    HEAP_PLANNER = okpk_heap_planner(history_file, java_args, min_heap, max_heap, budget)
+    return HEAP_PLANNER
+
+def run_jvm(cmd, inputs, kind, java_args_variable='ROBOT_JAVA_ARGS'):
+    """
+    :return: Runs a Java program like run_external, with the heap chosen by the heap planner if one is started.
+    """
+    if HEAP_PLANNER is None:
+        run_external(cmd)
+    else:
+        HEAP_PLANNER.run(cmd, inputs, kind, java_args_variable)
+
+def get_step_dependencies(steps):
+    """
+    :param steps: List of okpk_step
+    :return: Dictionary of step name to the set of names of the steps producing its inputs.
+    """
+    producers = dict()
+    for step in steps:
+        for output in step.outputs:
+            if output in producers:
+                raise Exception("{} is produced by both {} and {}".format(output, producers[output], step.name))
+            producers[output] = step.name
+    dependencies = dict()
+    for step in steps:
+        dependencies[step.name] = set([producers[i] for i in step.inputs if i in producers and producers[i] != step.name])
+    unresolved = dict((name, set(deps)) for name, deps in dependencies.items())
+    while unresolved:
+        ready = [name for name, deps in unresolved.items() if not deps]
+        if not ready:
+            raise Exception("Steps {} form a dependency cycle".format(", ".join(sorted(unresolved))))
+        for name in ready:
+            del unresolved[name]
+        for deps in unresolved.values():
+            deps.difference_update(ready)
+    return dependencies
+
+def is_step_done(step, skip=True, manifest=None):
+    if not skip or step.always_run or not step.outputs or not all(os.path.exists(output) for output in step.outputs):
+        return False
+    return manifest is None or manifest.is_up_to_date(step)
+
+def run_with_retries(step, action, label=""):
+    # The output of the external programs of the step is tagged with the ontology and the step
+    _step_context.ontology = label.strip("[]") or None
+    _step_context.step = step.name
+    try:
+        for attempt in range(step.retries + 1):
+            _step_context.deadline = time.time() + parse_duration(step.timeout) if step.timeout else None
+            try:
+                action()
+                return
+            except Exception as e:
+                if attempt >= step.retries:
+                    raise
+                delay = step.retry_backoff * 2 ** attempt
+                print("{} Step {} failed: {}. Retrying in {} seconds ({}/{}).".format(label, step.name, e, delay, attempt + 1, step.retries).strip())
+                time.sleep(delay)
+            finally:
+                _step_context.deadline = None
+    finally:
+        _step_context.ontology = None
+        _step_context.step = None
+
+def run_step(step, manifest=None, profiler=None, step_cache=None, label=""):
+    step_action = step.action
+    if step_cache is not None and step.cacheable:
+        step_action = lambda: step_cache.run(step, manifest, label)
+    action = lambda: run_with_retries(step, step_action, label)
+    if profiler is not None:
+        profiler.run(step, action)
+    else:
+        action()
+    if manifest is not None:
+        manifest.record(step)
+
+def run_steps(steps, max_workers=1, skip=True, label="", manifest=None, profiler=None, step_cache=None):
+    """
+    :param steps: List of okpk_step, in the order in which they are run when max_workers is 1
+    :param max_workers: Maximum number of steps that are run at the same time
+    :param skip: If True, steps whose outputs all exist are not run again
+    :param label: Prefix for progress messages, like the ontology id
+    :param manifest: Optional okpk_manifest. If given, steps are only skipped if their inputs and outputs did
+    not change since they were last run, and every successful step is recorded in the manifest.
+    :param profiler: Optional okpk_profiler that records the resource usage of every step
+    :param step_cache: Optional okpk_step_cache the outputs of cacheable steps are shared through
+    :return: Runs all steps as soon as the steps producing their inputs have finished. If a step fails, no new
+    steps are started and the first error is raised once the running steps are done.
+    """
+    dependencies = get_step_dependencies(steps)
+    max_workers = max(1, max_workers)
+    pending = list(steps)
+    done = set()
+    running = dict()
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            while error is None and len(running) < max_workers:
+                ready = [step for step in pending if dependencies[step.name] <= done]
+                if not ready:
+                    break
+                step = ready[0]
+                pending.remove(step)
+                if is_step_done(step, skip, manifest):
+                    print("{} Skipping {}, outputs are up to date.".format(label, step.name).strip())
+                    if profiler is not None:
+                        profiler.skip(step)
+                    done.add(step.name)
+                else:
+                    print("{} Running {}...".format(label, step.name).strip())
+                    running[executor.submit(run_step, step, manifest, profiler, step_cache, label)] = step
+            if not running:
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    future.result()
+                    done.add(step.name)
+                except Exception as e:
+                    print("{} Step {} failed: {}".format(label, step.name, e).strip())
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
+
+def merge_csv_files(csv_files, csv_out, dedupe=False):
+    """
+    :param csv_files: List of CSV files with a header row
+    :param csv_out: Output CSV file
+    :param dedupe: If True, rows that were already written are dropped
+    :return: Streams the rows of all csv_files into csv_out, using the header of the first file. Columns of the
+    other files are matched by name, so memory use does not depend on the size of the inputs. For deduplication,
+    only a 16 byte digest of every written row is kept in memory, so distinct rows are practically never dropped.
+    """
+    seen = set()
+    header = None
+    with atomic_output(csv_out) as tmp, open_text(tmp, 'w') as f_out:
+        writer = csv.writer(f_out)
+        for csv_file in csv_files:
+            with open_text(csv_file) as f_in:
+                reader = csv.reader(f_in)
+                file_header = next(reader, None)
+                if file_header is None:
+                    continue
+                if header is None:
+                    header = file_header
+                    writer.writerow(header)
+                order = [file_header.index(column) if column in file_header else None for column in header]
+                for row in reader:
+                    if file_header != header:
+                        row = [row[i] if i is not None and i < len(row) else "" for i in order]
+                    if dedupe:
+                        digest = hashlib.blake2b("\x1f".join(row).encode('utf-8'), digest_size=16).digest()
+                        if digest in seen:
+                            continue
+                        seen.add(digest)
+                    writer.writerow(row)
+
+# Columns that identify a record of each KGX output: a node, an edge, and the values of an annotation of a node
+KGX_DELTA_KEYS = {
+    "nodes": ['id'],
+    "edges": ['subject', 'relation', 'object'],
+    "annotations": ['id', 'annotation'],
+}
+
+def _read_kgx_index(index_file):
+    if not os.path.exists(index_file):
+        return
+    with open(index_file, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            yield tuple(row[:-1]), row[-1]
+
+def write_kgx_delta(kgx_file, key_columns, index_file, added_csv, removed_csv, changed_csv):
+    """
+    :param kgx_file: KGX CSV file of the current run
+    :param key_columns: Columns that identify a record, see KGX_DELTA_KEYS. All rows with the same key form one
+    record, so that for example all synonyms of a class change together.
+    :param index_file: Index of the previous run, replaced by the index of kgx_file: one row per key, sorted by
+    key, with a hash of the rows of the record
+    :param added_csv: Output: rows of the records that are new
+    :param removed_csv: Output: keys of the records that no longer exist
+    :param changed_csv: Output: rows of the records whose rows changed
+    :return: (added, removed, changed) record counts. Without a previous index, all records are added. Only the
+    keys and hashes are kept in memory, the previous index is merged in key order and kgx_file is read twice.
+    """
+    with open_text(kgx_file) as f:
+        reader = csv.reader(f)
+        header = next(reader, None) or []
+        key_index = [header.index(column) for column in key_columns]
+        records = dict()
+        for row in reader:
+            key = tuple(row[i] for i in key_index)
+            records.setdefault(key, []).append(hashlib.blake2b("\x1f".join(row).encode('utf-8'), digest_size=8).digest())
+    index = [(key, hashlib.blake2b(b"".join(sorted(digests)), digest_size=8).hexdigest()) for key, digests in records.items()]
+    index.sort()
+    del records
+
+    added, changed, removed = set(), set(), []
+    previous = _read_kgx_index(index_file)
+    old = next(previous, None)
+    for key, digest in index:
+        while old is not None and old[0] < key:
+            removed.append(old[0])
+            old = next(previous, None)
+        if old is not None and old[0] == key:
+            if old[1] != digest:
+                changed.add(key)
+            old = next(previous, None)
+        else:
+            added.add(key)
+    while old is not None:
+        removed.append(old[0])
+        old = next(previous, None)
+
+    with atomic_output(added_csv) as added_tmp, atomic_output(changed_csv) as changed_tmp, \
+            open_text(kgx_file) as f, open_text(added_tmp, 'w') as f_added, open_text(changed_tmp, 'w') as f_changed:
+        reader = csv.reader(f)
+        next(reader, None)
+        added_writer, changed_writer = csv.writer(f_added), csv.writer(f_changed)
+        added_writer.writerow(header)
+        changed_writer.writerow(header)
+        for row in reader:
+            key = tuple(row[i] for i in key_index)
+            if key in added:
+                added_writer.writerow(row)
+            elif key in changed:
+                changed_writer.writerow(row)
+    _write_kgx_csv(removed_csv, key_columns, removed)
+    tmp = index_file + ".tmp"
+    _write_kgx_csv(tmp, key_columns + ['hash'], [list(key) + [digest] for key, digest in index])
+    os.replace(tmp, index_file)
+    return len(added), len(removed), len(changed)
 
 def cdir(path):
     if not os.path.exists(path):
@@ -139,51 +1527,77 @@ def robot_extract_seed(ontology_path,seedfile,sparql_terms, TIMEOUT="60m", robot
 def robot_query(ontology_path,query_result,sparql_query, TIMEOUT="60m", robot_opts="-v",format='csv'):
     print("Querying "+ontology_path+" with "+sparql_query)
     try:
-        check_call(['timeout',TIMEOUT,'robot', 'query',robot_opts,'--use-graphs','true','-f',format,'-i', ontology_path,'--query', sparql_query, query_result])
+        robot_call(['query',robot_opts,'--use-graphs','true','-f',format,'-i', ontology_path,'--query', sparql_query, query_result],TIMEOUT)
     except Exception as e:
-        print(e.output)
-        raise Exception("Querying {} with {} failed".format(ontology_path,sparql_query))
+        print(e)
+        raise Exception("Querying {} with {} failed".format(ontology_path,sparql_query)) from e
+
+def robot_query_batch(ontology_path,queries, TIMEOUT="60m", robot_opts="-v"):
+    """
+    :param ontology_path: Input ontology
+    :param queries: List of (sparql_query, query_result, format) tuples
+    :param TIMEOUT: Java timeout parameter. String. Using timeout command line program.
+    :param robot_opts: Additional ROBOT options
+    :return: Runs all queries against a single load of ontology_path. ROBOT applies one result format to all
+    queries of an invocation, so queries are grouped into one invocation per format.
+    """
+    formats = []
+    for query in queries:
+        if query[2] not in formats:
+            formats.append(query[2])
+    for format in formats:
+        batch = [q for q in queries if q[2] == format]
+        print("Querying "+ontology_path+" with "+", ".join([q[0] for q in batch]))
+        try:
+            cmd = ['query',robot_opts,'--use-graphs','true','-f',format,'-i', ontology_path]
+            for sparql_query, query_result, _ in batch:
+                cmd.extend(['--query', sparql_query, query_result])
+            robot_call(cmd,TIMEOUT)
+        except Exception as e:
+            print(e)
+            raise Exception("Querying {} with {} failed".format(ontology_path,[q[0] for q in batch])) from e
 
 def robot_update(ontology_path,sparql_queries,ontology_out_path, TIMEOUT="60m", robot_opts="-v"):
     print("Querying "+ontology_path+" with "+str(sparql_queries))
     try:
         if sparql_queries:
-            robot = ['timeout',TIMEOUT,'robot', 'query',robot_opts,'-i', ontology_path]
+            robot = ['query',robot_opts,'-i', ontology_path]
             for ru in sparql_queries:
                 robot.extend(['--update', ru])
             robot.extend(['--output', ontology_out_path])
-            check_call(robot)
+            robot_call(robot,TIMEOUT)
         else:
             print("robot_update: No queries provided, copying input ontology unchanged.")
-            shutil.copyfile(ontology_path, ontology_out_path)
+            with atomic_output(ontology_out_path) as tmp:
+                shutil.copyfile(ontology_path, tmp)
     except Exception as e:
-        print(e.output)
-        raise Exception("Querying {} with {} failed".format(ontology_path,sparql_queries))
+        print(e)
+        raise Exception("Querying {} with {} failed".format(ontology_path,sparql_queries)) from e
 
 def robot_extract_module(ontology_path,seedfile, ontology_merged_path, TIMEOUT="60m", robot_opts="-v"):
     print("Extracting module of "+ontology_path+" to "+ontology_merged_path)
     try:
-        check_call(['timeout',TIMEOUT,'robot', 'extract',robot_opts,'-i', ontology_path,'-T', seedfile,'--method','BOT', '--output', ontology_merged_path])
+        robot_call(['extract',robot_opts,'-i', ontology_path,'-T', seedfile,'--method','BOT', '--output', ontology_merged_path],TIMEOUT)
     except Exception as e:
-        print(e.output)
-        raise Exception("Module extraction of " + ontology_path + " failed")
+        print(e)
+        raise Exception("Module extraction of " + ontology_path + " failed") from e
 
 def robot_dump_disjoints(ontology_path,term_file, ontology_removed_path, TIMEOUT="60m", robot_opts="-v"):
     print("Removing disjoint class axioms from "+ontology_path+" and saving to "+ontology_removed_path)
     try:
-        cmd = ['timeout',TIMEOUT,'robot', 'remove',robot_opts,'-i', ontology_path]
+        cmd = ['remove',robot_opts,'-i', ontology_path]
         if term_file:
             cmd.extend(['--term-file',term_file])
         cmd.extend(['--axioms','disjoint', '--output', ontology_removed_path])
-        check_call(cmd)
+        robot_call(cmd,TIMEOUT)
     except Exception as e:
-        print(e.output)
-        raise Exception("Removing disjoint class axioms from " + ontology_path + " failed")
+        print(e)
+        raise Exception("Removing disjoint class axioms from " + ontology_path + " failed") from e
 
 def robot_remove_terms(ontology_path,remove_list, ontology_removed_path, TIMEOUT="60m", robot_opts="-v"):
     print("Removing terms from "+ontology_path+" and saving to "+ontology_removed_path)
     try:
-        cmd = ['timeout',TIMEOUT,'robot', 'remove',robot_opts,'-i', ontology_path]
+        cmd = ['remove',robot_opts,'-i', ontology_path]
         terms = []
         patterns = []
         for t in remove_list:
@@ -197,18 +1611,18 @@ def robot_remove_terms(ontology_path,remove_list, ontology_removed_path, TIMEOUT
             cmd.extend(['remove','--select', pattern])
         cmd.extend(['--output', ontology_removed_path])
         print(str(cmd))
-        check_call(cmd)
+        robot_call(cmd,TIMEOUT)
     except Exception as e:
-        print(e.output)
-        raise Exception("Removing disjoint class axioms from " + ontology_path + " failed")
+        print(e)
+        raise Exception("Removing disjoint class axioms from " + ontology_path + " failed") from e
 
 def robot_remove_mentions_of_nothing(ontology_path, ontology_removed_path, TIMEOUT="60m", robot_opts="-v"):
     print("Removing mentions of nothing from "+ontology_path+" and saving to "+ontology_removed_path)
     try:
-        check_call(['timeout',TIMEOUT,'robot', 'remove',robot_opts,'-i', ontology_path,'--term','http://www.w3.org/2002/07/owl#Nothing', '--axioms','logical','--preserve-structure', 'false', '--output', ontology_removed_path])
+        robot_call(['remove',robot_opts,'-i', ontology_path,'--term','http://www.w3.org/2002/07/owl#Nothing', '--axioms','logical','--preserve-structure', 'false', '--output', ontology_removed_path],TIMEOUT)
     except Exception as e:
-        print(e.output)
-        raise Exception("Removing mentions of nothing from " + ontology_path + " failed")
+        print(e)
+        raise Exception("Removing mentions of nothing from " + ontology_path + " failed") from e
 
 def remove_all_sources_of_unsatisfiability(o, blacklist_ontology, TIMEOUT, robot_opts):
     robot_dump_disjoints(o, None, o, TIMEOUT, robot_opts)
@@ -220,31 +1634,31 @@ def remove_all_sources_of_unsatisfiability(o, blacklist_ontology, TIMEOUT, robot
 def robot_remove_axioms_that_could_cause_unsat(ontology_path, ontology_removed_path, TIMEOUT="60m", robot_opts="-v"):
     print("Removing axioms that could cause unsat from "+ontology_path+" and saving to "+ontology_removed_path)
     try:
-        check_call(['timeout',TIMEOUT,'robot', 'remove',robot_opts,'-i', ontology_path, '--axioms','"DisjointClasses DisjointUnion DifferentIndividuals NegativeObjectPropertyAssertion NegativeDataPropertyAssertion FunctionalObjectProperty InverseFunctionalObjectProperty ReflexiveObjectProperty IrrefexiveObjectProperty ObjectPropertyDomain ObjectPropertyRange DisjointObjectProperties FunctionalDataProperty DataPropertyDomain DataPropertyRange DisjointDataProperties"','--preserve-structure', 'false', '--output', ontology_removed_path])
+        robot_call(['remove',robot_opts,'-i', ontology_path, '--axioms','"DisjointClasses DisjointUnion DifferentIndividuals NegativeObjectPropertyAssertion NegativeDataPropertyAssertion FunctionalObjectProperty InverseFunctionalObjectProperty ReflexiveObjectProperty IrrefexiveObjectProperty ObjectPropertyDomain ObjectPropertyRange DisjointObjectProperties FunctionalDataProperty DataPropertyDomain DataPropertyRange DisjointDataProperties"','--preserve-structure', 'false', '--output', ontology_removed_path],TIMEOUT)
     except Exception as e:
-        print(e.output)
-        raise Exception("Removing mentions of nothing from " + ontology_path + " failed")
+        print(e)
+        raise Exception("Removing mentions of nothing from " + ontology_path + " failed") from e
 
 def robot_remove_upheno_blacklist_and_classify(ontology_path, ontology_removed_path, blacklist_ontology, TIMEOUT="3600", robot_opts="-v"):
     print("Removing upheno blacklist axioms from "+ontology_path+" and saving to "+ontology_removed_path)
     try:
-        check_call(['timeout',TIMEOUT,'robot', 'merge',robot_opts,'-i', ontology_path,'unmerge', '-i', blacklist_ontology,'reason', '--reasoner','ELK', '--output', ontology_removed_path])
+        robot_call(['merge',robot_opts,'-i', ontology_path,'unmerge', '-i', blacklist_ontology,'reason', '--reasoner','ELK', '--output', ontology_removed_path],TIMEOUT)
     except Exception as e:
-        print(e.output)
-        raise Exception("Removing mentions of nothing from " + ontology_path + " failed")
+        print(e)
+        raise Exception("Removing mentions of nothing from " + ontology_path + " failed") from e
 
 def robot_merge(ontology_list, ontology_merged_path, TIMEOUT="3600", robot_opts="-v", ONTOLOGYIRI="http://ontology.com/someuri.owl"):
     print("Merging " + str(ontology_list) + " to " + ontology_merged_path)
     try:
-        callstring = ['timeout', TIMEOUT, 'robot', 'merge', robot_opts]
+        callstring = ['merge', robot_opts]
         merge = " ".join(["--input " + s for s in ontology_list]).split(" ")
         callstring.extend(merge)
         callstring.extend(["annotate", "--ontology-iri",ONTOLOGYIRI])
         callstring.extend(['--output', ontology_merged_path])
-        check_call(callstring)
+        robot_call(callstring,TIMEOUT)
     except Exception as e:
         print(e)
-        raise Exception("Merging of" + str(ontology_list) + " failed")
+        raise Exception("Merging of" + str(ontology_list) + " failed") from e
 
 def list_files(directory, extension):
     return (f for f in os.listdir(directory) if f.endswith('.' + extension))
@@ -252,10 +1666,12 @@ def list_files(directory, extension):
 def dosdp_pattern_match(ontology_path, pattern_path, out_tsv, TIMEOUT="3600"):
     print("Matching " + ontology_path + " with " + pattern_path+" to "+out_tsv)
     try:
-        check_call(['timeout', TIMEOUT, 'dosdp-tools', 'query', '--ontology='+ontology_path, '--reasoner=elk', '--obo-prefixes=true', '--template='+pattern_path,'--outfile='+out_tsv])
+        with atomic_output(out_tsv) as tmp:
+            run_jvm(['timeout', TIMEOUT, 'dosdp-tools', 'query', '--ontology='+ontology_path, '--reasoner=elk', '--obo-prefixes=true', '--template='+pattern_path,'--outfile='+tmp],
+                [ontology_path], "reason", 'JAVA_OPTS')
     except Exception as e:
         print(e)
-        raise Exception("Matching " + str(ontology_path) + " for DOSDP: " + pattern_path + " failed")
+        raise Exception("Matching " + str(ontology_path) + " for DOSDP: " + pattern_path + " failed") from e
 
 def robot_prepare_ontology_for_dosdp(o, ontology_merged_path,sparql_terms_class_hierarchy, TIMEOUT="3600", robot_opts="-v"):
     """
@@ -273,18 +1689,18 @@ def robot_prepare_ontology_for_dosdp(o, ontology_merged_path,sparql_terms_class_
     robot_extract_seed(o, subclass_hierarchy_seed, sparql_terms_class_hierarchy, TIMEOUT, robot_opts)
     robot_class_hierarchy(o, subclass_hierarchy_seed,subclass_hierarchy,REASON=True,REMOVEDISJOINT=False,TIMEOUT=TIMEOUT,robot_opts=robot_opts)
     try:
-        callstring = ['timeout', TIMEOUT, 'robot', 'merge', robot_opts,"-i",o,"-i",subclass_hierarchy]
+        callstring = ['merge', robot_opts,"-i",o,"-i",subclass_hierarchy]
         callstring.extend(['remove','--term', 'rdfs:label', '--select', 'complement', '--select', 'annotation-properties', '--preserve-structure', 'false'])
         callstring.extend(['--output', ontology_merged_path])
-        check_call(callstring)
+        robot_call(callstring,TIMEOUT)
     except Exception as e:
         print(e)
-        raise Exception("Preparing " + str(o) + " for DOSDP: " + ontology_merged_path + " failed")
+        raise Exception("Preparing " + str(o) + " for DOSDP: " + ontology_merged_path + " failed") from e
 
 def robot_upheno_release(ontology_list, ontology_merged_path, name, TIMEOUT="3600", robot_opts="-v",remove_terms=None):
     print("Finalising  " + str(ontology_list) + " to " + ontology_merged_path+", "+name)
     try:
-        callstring = ['timeout', TIMEOUT, 'robot', 'merge', robot_opts]
+        callstring = ['merge', robot_opts]
         merge = " ".join(["--input " + s for s in ontology_list]).split(" ")
         callstring.extend(merge)
         callstring.extend(['remove', '--axioms', 'disjoint', '--preserve-structure', 'false'])
@@ -293,50 +1709,43 @@ def robot_upheno_release(ontology_list, ontology_merged_path, name, TIMEOUT="360
             callstring.extend(['remove', '-T', remove_terms, '--preserve-structure', 'false'])
         callstring.extend(['reason','--reasoner','ELK','reduce','--reasoner','ELK'])
         callstring.extend(['--output', ontology_merged_path])
-        check_call(callstring)
+        robot_call(callstring,TIMEOUT)
     except Exception as e:
         print(e)
-        raise Exception("Finalising " + str(ontology_list) + " failed...")
+        raise Exception("Finalising " + str(ontology_list) + " failed...") from e
 
 def robot_upheno_component(component_file,remove_eqs, TIMEOUT="3600", robot_opts="-v"):
     #robot remove --axioms "disjoint" --preserve-structure false reason --reasoner ELK -o /data/upheno_pre-fixed_mp-hp.owl
     print("Preparing uPheno component  " + str(component_file))
     try:
-        callstring = ['timeout', TIMEOUT, 'robot', 'merge','-i',component_file]
+        callstring = ['merge','-i',component_file]
         callstring.extend(['remove','-T',remove_eqs,'--axioms','equivalent','--preserve-structure','false'])
         callstring.extend(['--output', component_file])
-        check_call(callstring)
+        robot_call(callstring,TIMEOUT)
     except Exception as e:
         print(e)
-        raise Exception("Preparing uPheno component " + str(component_file) + " failed...")
+        raise Exception("Preparing uPheno component " + str(component_file) + " failed...") from e
 
 def robot_children_list(o,query,outfile,TIMEOUT="3600",robot_opts="-v"):
     print("Extracting children from  " + str(o) +" using "+str(query))
     try:
-        check_call(['timeout',TIMEOUT,'robot', 'query',robot_opts,'--use-graphs','true','-f','csv','-i', o,'--query', query, outfile])
+        robot_call(['query',robot_opts,'--use-graphs','true','-f','csv','-i', o,'--query', query, outfile],TIMEOUT)
 
     except Exception as e:
         print(e)
-        raise Exception("Preparing uPheno component " + str(o) + " failed...")
+        raise Exception("Preparing uPheno component " + str(o) + " failed...") from e
 
 
 def get_defined_phenotypes(upheno_config,pattern_dir,matches_dir):
-    defined = []
-    for pattern in os.listdir(pattern_dir):
-        if pattern.endswith(".yaml"):
-            tsv_file_name = pattern.replace(".yaml",".tsv")
-            for oid in upheno_config.get_phenotype_ontologies():
-                tsv = os.path.join(matches_dir,oid,tsv_file_name)
-                if os.path.exists(tsv):
-                    df = pd.read_csv(tsv, sep='\t')
-                    defined.extend(df['defined_class'].tolist())
-    return list(set(defined))
+    patterns = [get_pattern_name(pattern) for pattern in os.listdir(pattern_dir) if pattern.endswith(".yaml")]
+    index = okpk_defined_class_index.build(matches_dir,upheno_config.get_phenotype_ontologies(),patterns)
+    return list(index.get())
 
 
 def robot_class_hierarchy(ontology_in_path, class_hierarchy_seed, ontology_out_path, REASON = True , TIMEOUT="3600", robot_opts="-v", REMOVEDISJOINT=False):
     print("Extracting class hierarchy from " + str(ontology_in_path) + " to " + ontology_out_path + "(Reason: "+str(REASON)+")")
     try:
-        callstring = ['timeout', TIMEOUT, 'robot', 'merge', robot_opts,"--input",ontology_in_path]
+        callstring = ['merge', robot_opts,"--input",ontology_in_path]
         if REMOVEDISJOINT:
             callstring.extend(['remove','--axioms','disjoint','--preserve-structure', 'false'])
             callstring.extend(['remove','--term','http://www.w3.org/2002/07/owl#Nothing', '--axioms','logical','--preserve-structure', 'false'])
@@ -345,10 +1754,10 @@ def robot_class_hierarchy(ontology_in_path, class_hierarchy_seed, ontology_out_p
             callstring.extend(['reason','--reasoner','ELK'])
 
         callstring.extend(['filter','-T',class_hierarchy_seed,'--axioms','subclass','--preserve-structure','false','--trim','false','--output', ontology_out_path])
-        check_call(callstring)
+        robot_call(callstring,TIMEOUT)
     except Exception as e:
         print(e)
-        raise Exception("Extracting class hierarchy from " + str(ontology_in_path) + " to " + ontology_out_path + " failed")
+        raise Exception("Extracting class hierarchy from " + str(ontology_in_path) + " to " + ontology_out_path + " failed") from e
 
 
 def dosdp_generate(pattern,tsv,outfile, RESTRICT_LOGICAL=False,TIMEOUT="3600",ONTOLOGY=None):
@@ -359,29 +1768,129 @@ def dosdp_generate(pattern,tsv,outfile, RESTRICT_LOGICAL=False,TIMEOUT="3600",ON
             callstring.extend(['--restrict-axioms-to=logical'])
         if ONTOLOGY is not None:
             callstring.extend(['--ontology='+ONTOLOGY])
-        callstring.extend(['--outfile=' + outfile])
-        check_call(callstring)
-    except:
-        raise Exception("Pattern generation failed: "+pattern+", "+tsv+", "+outfile+".")
+        with atomic_output(outfile) as tmp:
+            callstring.extend(['--outfile=' + tmp])
+            run_jvm(callstring, [tsv] + ([ONTOLOGY] if ONTOLOGY is not None else []), "convert", 'JAVA_OPTS')
+    except Exception as e:
+        raise Exception("Pattern generation failed: "+pattern+", "+tsv+", "+outfile+".") from e
 
+def get_pattern_name(pattern_path):
+    return os.path.basename(pattern_path)[:-len(".yaml")]
 
-def dosdp_extract_pattern_seed(tsv_files,seedfile):
-    classes = []
+def dosdp_match_steps(ontologies, patterns, prepared_dir, matches_dir, sparql_terms_class_hierarchy, TIMEOUT="3600", robot_opts="-v"):
+    """
+    :param ontologies: Dictionary of ontology id to ontology file
+    :param patterns: DOSDP pattern files (.yaml)
+    :param prepared_dir: Directory for the ontologies prepared with robot_prepare_ontology_for_dosdp
+    :param matches_dir: Directory for the matches, written to matches_dir/ONTOLOGY/PATTERN.tsv like
+    get_defined_phenotypes expects them
+    :param sparql_terms_class_hierarchy: SPARQL query that extracts the seed of the class hierarchy
+    :return: List of okpk_step: one step per ontology that prepares it for DOSDP, and one step per pattern and
+    ontology that matches the pattern against the prepared ontology. Every ontology is prepared once and the
+    matching steps only depend on the preparation of their ontology, so run_steps runs them as soon as it is done.
+    """
+    steps = []
+    for oid, ontology in sorted(ontologies.items()):
+        prepared = os.path.join(prepared_dir, "{}_dosdp.owl".format(oid))
+        cdir(os.path.join(matches_dir, oid))
+        steps.append(okpk_step("prepare_{}".format(oid),
+            lambda ontology=ontology, prepared=prepared: robot_prepare_ontology_for_dosdp(ontology, prepared, sparql_terms_class_hierarchy, TIMEOUT, robot_opts),
+            inputs=[ontology, sparql_terms_class_hierarchy], outputs=[prepared]))
+        for pattern in sorted(patterns):
+            tsv = os.path.join(matches_dir, oid, get_pattern_name(pattern) + ".tsv")
+            steps.append(okpk_step("match_{}_{}".format(oid, get_pattern_name(pattern)),
+                lambda prepared=prepared, pattern=pattern, tsv=tsv: dosdp_pattern_match(prepared, pattern, tsv, TIMEOUT),
+                inputs=[prepared, pattern], outputs=[tsv]))
+    return steps
+
+def dosdp_generate_steps(jobs, RESTRICT_LOGICAL=False, TIMEOUT="3600", ONTOLOGY=None):
+    """
+    :param jobs: List of (pattern file, TSV file, output file)
+    :return: List of okpk_step that run dosdp_generate for every job.
+    """
+    return [okpk_step("generate_{}".format(os.path.basename(outfile)),
+        lambda pattern=pattern, tsv=tsv, outfile=outfile: dosdp_generate(pattern, tsv, outfile, RESTRICT_LOGICAL, TIMEOUT, ONTOLOGY),
+        inputs=[pattern, tsv] + ([ONTOLOGY] if ONTOLOGY is not None else []), outputs=[outfile], params=RESTRICT_LOGICAL)
+        for pattern, tsv, outfile in jobs]
+
+def dosdp_match_all(ontologies, pattern_dir, build_dir, sparql_terms_class_hierarchy, max_workers=1, skip=True, TIMEOUT="3600", robot_opts="-v"):
+    """
+    :param ontologies: Dictionary of ontology id to ontology file
+    :param pattern_dir: Directory with the DOSDP patterns (.yaml)
+    :param build_dir: Directory for the prepared ontologies, the matches (build_dir/matches) and the manifest
+    :param sparql_terms_class_hierarchy: SPARQL query that extracts the seed of the class hierarchy
+    :param max_workers: Number of preparation and matching steps run at the same time. Every step is a separate
+    JVM, so with a heap planner and memory budget the concurrent JVMs also wait for memory.
+    :param skip: If True, matches whose ontology and pattern did not change since the last run are not repeated
+    :return: Matches all patterns against all ontologies and returns the okpk_defined_class_index of the matches.
+    """
+    patterns = [os.path.join(pattern_dir, p) for p in sorted(os.listdir(pattern_dir)) if p.endswith(".yaml")]
+    matches_dir = os.path.join(build_dir, "matches")
+    cdir(matches_dir)
+    steps = dosdp_match_steps(ontologies, patterns, build_dir, matches_dir, sparql_terms_class_hierarchy, TIMEOUT, robot_opts)
+    manifest = okpk_manifest(os.path.join(build_dir, "manifest_dosdp.json"), get_robot_version())
+    run_steps(steps, max_workers, skip, "[dosdp]", manifest)
+    return okpk_defined_class_index.build(matches_dir, list(ontologies), [get_pattern_name(p) for p in patterns])
+
+class okpk_defined_class_index:
+    """
+    Defined classes of DOSDP matches, by pattern and ontology, read from all matches TSVs in a single pass.
+    """
+    def __init__(self):
+        self.defined = dict()
+
+    @staticmethod
+    def build(matches_dir, ontologies=None, patterns=None):
+        """
+        :param matches_dir: Directory with the matches, as matches_dir/ONTOLOGY/PATTERN.tsv
+        :param ontologies: Ontology ids to read (default: all directories in matches_dir)
+        :param patterns: Pattern names to read, without .yaml (default: all TSV files)
+        """
+        index = okpk_defined_class_index()
+        if ontologies is None:
+            ontologies = [d for d in os.listdir(matches_dir) if os.path.isdir(os.path.join(matches_dir, d))]
+        for oid in ontologies:
+            o_matches_dir = os.path.join(matches_dir, oid)
+            if not os.path.isdir(o_matches_dir):
+                continue
+            names = patterns if patterns is not None else [f[:-len(".tsv")] for f in os.listdir(o_matches_dir) if f.endswith(".tsv")]
+            for pattern in names:
+                tsv = os.path.join(o_matches_dir, pattern + ".tsv")
+                if os.path.exists(tsv):
+                    index.add(pattern, oid, iter_csv_columns(tsv, ['defined_class'], '\t'))
+        return index
+
+    def add(self, pattern, oid, classes):
+        defined = self.defined.setdefault(pattern, dict()).setdefault(oid, set())
+        defined.update(sys.intern(c) for c in classes if c)
+
+    def get(self, patterns=None, ontologies=None):
+        """
+        :return: Set of the classes defined by any of patterns (default: all) in any of ontologies (default: all).
+        """
+        classes = set()
+        for pattern in (self.defined if patterns is None else patterns):
+            for oid, defined in self.defined.get(pattern, dict()).items():
+                if ontologies is None or oid in ontologies:
+                    classes.update(defined)
+        return classes
+
+
+def dosdp_extract_pattern_seed(tsv_files,seedfile,sort=False):
+    """
+    :param tsv_files: DOSDP pattern match results
+    :param seedfile: Output file with the defined classes of all tsv_files, one per line
+    :param sort: If True, the seed is written in sorted order
+    """
     try:
-        for tsv in tsv_files:
-            print("TSV:" +tsv)
-            df = pd.read_csv(tsv, sep='\t')
-            print(tsv+" done")
-            classes.extend(df['defined_class'])
-        with open(seedfile, 'w') as f:
-            for item in list(set(classes)):
-                f.write("%s\n" % item)
+        terms = itertools.chain.from_iterable(iter_csv_columns(tsv,['defined_class'],'\t') for tsv in tsv_files)
+        write_seed_terms(terms,seedfile,sort)
     except Exception as e:
         print(e)
-        raise Exception("Extracting seed from all TSV files failed..")
+        raise Exception("Extracting seed from all TSV files failed..") from e
 
 def write_list_to_file(file_path,list):
-    with open(file_path, 'w') as f:
+    with atomic_output(file_path) as tmp, open(tmp, 'w') as f:
         for item in list:
             f.write("%s\n" % item)
 
@@ -395,65 +1904,141 @@ def rm(path):
     else:  ## Show an error ##
         print("Error: %s file not found" % path)
     
+def okpk_enrich_args(ontologies,materialize_props,module_terms=None):
+    cmd = ['merge']
+    for o in ontologies:
+        cmd.extend(['-i', o])
+    if module_terms:
+        cmd.extend(['extract', '--method', 'BOT', '--term-file', module_terms])
+    cmd.extend(['reason', '--reasoner', 'ELK'])
+    if materialize_props:
+        cmd.extend(['materialize', '--reasoner', 'ELK'])
+        for p in materialize_props:
+            cmd.extend(['--term', p])
+    cmd.extend(['relax'])
+    return cmd
+
+def okpk_reduce_args(properties):
+    cmd = ['remove']
+    for p in properties:
+        cmd.extend(['--term', p])
+    cmd.extend(['--select','complement','--select', 'object-properties'])
+    return cmd
+
+def okpk_finish_args(seed_file):
+    return ['filter', '-T', seed_file, '--signature', 'true']
+
 def robot_okpk_enrich(ontologies,materialize_props,ontology_path, TIMEOUT="60m", robot_opts="-v"):
     try:
-        cmd = ['timeout',TIMEOUT]
-        cmd.extend(['robot',robot_opts, 'merge'])
-        for o in ontologies:
-            cmd.extend(['-i', o])
-        cmd.extend(['reason', '--reasoner', 'ELK'])
-        if materialize_props:
-            cmd.extend(['materialize', '--reasoner', 'ELK'])
-            for p in materialize_props:
-                cmd.extend(['--term', p])
-        cmd.extend(['relax'])
+        cmd = [robot_opts] + okpk_enrich_args(ontologies,materialize_props)
         cmd.extend(['-o',ontology_path])
-        check_call(cmd)
+        robot_call(cmd,TIMEOUT)
     except Exception as e:
-        print(e.output)
-        raise Exception("Running ROBOT Pipeline towards {} failed".format(ontology_path))
+        print(e)
+        raise Exception("Running ROBOT Pipeline towards {} failed".format(ontology_path)) from e
         
 def robot_okpk_reduce(o,properties,ontology_path, TIMEOUT="60m", robot_opts="-v"):
     try:
         if properties:
-            cmd = ['timeout',TIMEOUT]
-            cmd.extend(['robot',robot_opts])
-            
-            cmd.extend(['remove', '-i',o])
-            for p in properties:
-                cmd.extend(['--term', p])
-            cmd.extend(['--select','complement','--select', 'object-properties'])
+            cmd = [robot_opts] + okpk_reduce_args(properties)
+            cmd[2:2] = ['-i',o]
             cmd.extend(['-o',ontology_path])
-            check_call(cmd)
+            robot_call(cmd,TIMEOUT)
         else:
-            shutil.copyfile(o, ontology_path)
+            with atomic_output(ontology_path) as tmp:
+                shutil.copyfile(o, tmp)
     except Exception as e:
-        print(e.output)
-        raise Exception("Running ROBOT Pipeline towards {} failed".format(ontology_path))
+        print(e)
+        raise Exception("Running ROBOT Pipeline towards {} failed".format(ontology_path)) from e
 
 def robot_okpk_finish(o,seed_file,ontology_path, TIMEOUT="60m", robot_opts="-v"):
     try:
-        cmd = ['timeout',TIMEOUT]
-        cmd.extend(['robot',robot_opts])
-        cmd.extend(['filter', '-i',o])
-        cmd.extend(['-T',seed_file])
-        cmd.extend(['--signature','true'])
+        cmd = [robot_opts] + okpk_finish_args(seed_file)
+        cmd[2:2] = ['-i',o]
         cmd.extend(['-o',ontology_path])
-        check_call(cmd)
+        robot_call(cmd,TIMEOUT)
     except Exception as e:
-        print(e.output)
-        raise Exception("Running ROBOT Pipeline towards {} failed".format(ontology_path))
-        
+        print(e)
+        raise Exception("Running ROBOT Pipeline towards {} failed".format(ontology_path)) from e
+
+def robot_okpk_fused(ontologies,materialize_props,properties,count_queries,seed_query,seed_file,ontology_path,enriched_path=None,reduced_path=None, TIMEOUT="60m", robot_opts="-v"):
+    """
+    :param ontologies: Source ontologies
+    :param materialize_props: Object properties that are materialised
+    :param properties: Object properties that are kept, all others are removed
+    :param count_queries: List of (sparql_query, query_result) tuples run against the enriched ontology
+    :param seed_query: SPARQL query with a single result column of all terms to keep, run against the reduced ontology
+    :param seed_file: Result of seed_query, used as the term file of the final filter
+    :param ontology_path: Output ontology
+    :param enriched_path: If given, the enriched ontology is also written to this file
+    :param reduced_path: If given, the reduced ontology is also written to this file
+    :param TIMEOUT: Java timeout parameter. String. Using timeout command line program.
+    :param robot_opts: Additional ROBOT options
+    :return: Runs enrich, count, reduce, seed and finish as a single ROBOT command chain, so the ontology is
+    loaded and reasoned over once and intermediate ontologies are only serialised if requested. ROBOT reads the
+    term file of filter when the command runs, so the seed written by the query earlier in the chain is used.
+    """
+    try:
+        cmd = [robot_opts] + okpk_enrich_args(ontologies,materialize_props)
+        if enriched_path:
+            cmd.extend(['-o',enriched_path])
+        if count_queries:
+            cmd.extend(['query','--use-graphs','true','-f','csv'])
+            for sparql_query, query_result in count_queries:
+                cmd.extend(['--query', sparql_query, query_result])
+        if properties:
+            cmd.extend(okpk_reduce_args(properties))
+            if reduced_path:
+                cmd.extend(['-o',reduced_path])
+        elif reduced_path:
+            cmd.extend(['convert','-o',reduced_path])
+        cmd.extend(['query','--use-graphs','true','-f','csv','--query',seed_query,seed_file])
+        cmd.extend(okpk_finish_args(seed_file))
+        cmd.extend(['-o',ontology_path])
+        robot_call(cmd,TIMEOUT)
+    except Exception as e:
+        print(e)
+        raise Exception("Running ROBOT Pipeline towards {} failed".format(ontology_path)) from e
+
+def robot_okpk_module(ontologies,module_terms,materialize_props,properties,ontology_path, TIMEOUT="60m", robot_opts="-v"):
+    """
+    :param ontologies: Source ontologies
+    :param module_terms: Term file with the classes to extract a module for
+    :param materialize_props: Object properties that are materialised
+    :param properties: Object properties that are kept, all others are removed
+    :param ontology_path: Output ontology
+    :param TIMEOUT: Java timeout parameter. String. Using timeout command line program.
+    :param robot_opts: Additional ROBOT options
+    :return: Runs enrich and reduce on the BOT module of module_terms only. The module preserves all entailments
+    about the terms, so their inferred superclasses and materialised relations are the same as in the full
+    ontology.
+    """
+    try:
+        cmd = [robot_opts] + okpk_enrich_args(ontologies,materialize_props,module_terms)
+        if properties:
+            cmd.extend(okpk_reduce_args(properties))
+        cmd.extend(['-o',ontology_path])
+        robot_call(cmd,TIMEOUT)
+    except Exception as e:
+        print(e)
+        raise Exception("Running ROBOT Pipeline towards {} failed".format(ontology_path)) from e
+
 def robot_convert(o,format,ontology_path, TIMEOUT="60m", robot_opts="-v"):
     try:
-        cmd = ['timeout',TIMEOUT]
-        cmd.extend(['robot',robot_opts])
+        # ROBOT writes gzipped outputs itself, zstd compressed outputs are compressed once ROBOT is done
+        output = ontology_path
+        if get_compression(ontology_path) == "zstd":
+            output = get_tmp_path(ontology_path)[:-len(COMPRESSION_EXTENSIONS["zstd"])]
+        cmd = [robot_opts]
         cmd.extend(['convert', '-i',o,'--format', format])
-        cmd.extend(['-o',ontology_path])
-        check_call(cmd)
+        cmd.extend(['-o',output])
+        robot_call(cmd,TIMEOUT)
+        if output != ontology_path:
+            compress_file(output,ontology_path)
+            os.remove(output)
     except Exception as e:
-        print(e.output)
-        raise Exception("Converting {} to {} failed".format(ontology_path,format))
+        print(e)
+        raise Exception("Converting {} to {} failed".format(ontology_path,format)) from e
 
 def prepare_role_chains(o,role_chains,curie_map,role_chains_out_file):
     ontology = ['Prefix(:=<http://ontology-kg-preprocessing-kit.org/inject/{}_chains.owl#>)'.format(o)]
@@ -480,20 +2065,188 @@ def prepare_role_chains(o,role_chains,curie_map,role_chains_out_file):
     ontology.append(')')
     write_list_to_file(role_chains_out_file,ontology)
 
-def download_from_urls(o,sources,o_build_dir,skip=False):
-    i = 1
-    downloads = []
-    for s in sources:
-        source_file = os.path.join(o_build_dir,'{}_source_{}.owl'.format(o,i))
-        if not skip or not os.path.exists(source_file):
-            urllib.request.urlretrieve(s,source_file)
-        i += 1
-        downloads.append(source_file)
+def get_source_files(o,sources,o_build_dir):
+    return [os.path.join(o_build_dir,'{}_source_{}.owl'.format(o,i)) for i in range(1,len(sources)+1)]
+
+class okpk_download_cache:
+    """
+    Content-addressed cache of downloaded files, shared by all ontologies and runs. Files are stored by their
+    SHA-256 checksum; for every URL the cache records the checksum and the ETag and Last-Modified headers
+    of the last download, so that cached files are revalidated with conditional requests. Interrupted downloads
+    are resumed with range requests. In offline mode, files are only served from the cache.
+    """
+    def __init__(self, cache_dir, offline=False, block_size=1024 * 1024):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.block_size = block_size
+        self.validated = dict()
+        self.lock = threading.Lock()
+        for d in ['blobs', 'urls', 'partial']:
+            cdir(os.path.join(cache_dir, d))
+
+    def _url_key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _metadata_file(self, url):
+        return os.path.join(self.cache_dir, 'urls', self._url_key(url) + '.json')
+
+    def _blob(self, checksum):
+        return os.path.join(self.cache_dir, 'blobs', checksum)
+
+    def _load_metadata(self, url):
+        metadata_file = self._metadata_file(url)
+        if os.path.exists(metadata_file):
+            with open(metadata_file, 'r') as f:
+                return json.load(f)
+        return None
+
+    def _save_metadata(self, url, metadata):
+        metadata_file = self._metadata_file(url)
+        with open(metadata_file + '.tmp', 'w') as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(metadata_file + '.tmp', metadata_file)
+
+    def _is_valid(self, metadata):
+        if not metadata or not os.path.exists(self._blob(metadata['sha256'])):
+            return False
+        blob = self._blob(metadata['sha256'])
+        return os.path.getsize(blob) == metadata['size'] and hash_file(blob) == metadata['sha256']
+
+    def fetch(self, url):
+        """
+        :param url: URL of the file
+        :return: Path to the cached copy of the file, downloaded or revalidated at most once per run.
+        """
+        with self.lock:
+            if url in self.validated:
+                return self.validated[url]
+        metadata = self._load_metadata(url)
+        cached = self._is_valid(metadata)
+        if self.offline:
+            if not cached:
+                raise Exception("{} is not in the download cache {} (offline mode)".format(url, self.cache_dir))
+            print("Using cached {} (offline mode)".format(url))
+        else:
+            metadata = self._download(url, metadata if cached else None)
+        blob = self._blob(metadata['sha256'])
+        with self.lock:
+            self.validated[url] = blob
+        return blob
+
+    def _download(self, url, metadata):
+        partial = os.path.join(self.cache_dir, 'partial', self._url_key(url))
+        partial_metadata = self._load_partial_metadata(partial)
+        request = urllib.request.Request(url)
+        if metadata:
+            if metadata.get('etag'):
+                request.add_header('If-None-Match', metadata['etag'])
+            if metadata.get('last_modified'):
+                request.add_header('If-Modified-Since', metadata['last_modified'])
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        validator = partial_metadata.get('etag') or partial_metadata.get('last_modified')
+        if offset and validator:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+            request.add_header('If-Range', validator)
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and metadata:
+                print("Cached {} is up to date".format(url))
+                return metadata
+            if e.code == 416 and offset:
+                print("Discarding partial download of {}".format(url))
+                os.remove(partial)
+                return self._download(url, metadata)
+            raise
+        with response:
+            headers = response.headers
+            etag = headers.get('ETag')
+            last_modified = headers.get('Last-Modified')
+            resumed = offset and response.getcode() == 206
+            if resumed:
+                print("Resuming download of {} at byte {}".format(url, offset))
+            else:
+                print("Downloading {}".format(url))
+                offset = 0
+            self._save_partial_metadata(partial, etag, last_modified)
+            expected = headers.get('Content-Length')
+            with open(partial, 'ab' if resumed else 'wb') as f:
+                for block in iter(lambda: response.read(self.block_size), b''):
+                    f.write(block)
+        size = os.path.getsize(partial)
+        if expected is not None and size != offset + int(expected):
+            raise Exception("Download of {} is incomplete: {} of {} bytes".format(url, size, offset + int(expected)))
+        checksum = hash_file(partial)
+        if os.path.exists(self._blob(checksum)):
+            os.remove(partial)
+        else:
+            os.replace(partial, self._blob(checksum))
+        os.remove(partial + '.json')
+        metadata = {'url': url, 'sha256': checksum, 'size': size, 'etag': etag, 'last_modified': last_modified}
+        self._save_metadata(url, metadata)
+        return metadata
+
+    def _load_partial_metadata(self, partial):
+        if os.path.exists(partial) and os.path.exists(partial + '.json'):
+            with open(partial + '.json', 'r') as f:
+                return json.load(f)
+        return dict()
+
+    def _save_partial_metadata(self, partial, etag, last_modified):
+        with open(partial + '.json', 'w') as f:
+            json.dump({'etag': etag, 'last_modified': last_modified}, f)
+
+    def copy_to(self, url, target):
+        """
+        :param url: URL of the file
+        :param target: Path the file is made available at
+        :return: Links (or, across file systems, copies) the cached file to target. If target already is the
+        cached file, it is left untouched, so its modification time only changes when the content changes.
+        """
+        blob = self.fetch(url)
+        if os.path.exists(target) and os.path.samefile(blob, target):
+            return
+        link_or_copy(blob, target)
+
+def prefetch_urls(urls, download_cache, max_workers=4):
+    """
+    :param urls: List of URLs
+    :param download_cache: okpk_download_cache
+    :param max_workers: Maximum number of parallel downloads
+    :return: Downloads or revalidates all urls in parallel, so that later lookups are served from the cache, and
+    returns the urls that failed. Failed urls are fetched again, with retries, by the download step of every
+    ontology that uses them, so a failing source only fails these ontologies.
+    """
+    urls = list(dict.fromkeys(urls))
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(download_cache.fetch, url): url for url in urls}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("Fetching {} failed: {}".format(futures[future], e))
+                failed.append(futures[future])
+    return failed
+
+def download_from_urls(o,sources,o_build_dir,skip=False,download_cache=None):
+    downloads = get_source_files(o,sources,o_build_dir)
+    for s, source_file in zip(sources,downloads):
+        # Compressed sources (.gz, .zst) are downloaded as they are and decompressed next to them
+        compression = get_compression(urllib.parse.urlparse(s).path)
+        download = source_file + COMPRESSION_EXTENSIONS[compression] if compression else source_file
+        if download_cache is not None:
+            download_cache.copy_to(s,download)
+        elif not skip or not os.path.exists(download):
+            with atomic_output(download) as tmp:
+                urllib.request.urlretrieve(s,tmp)
+        if compression and (not os.path.exists(source_file) or os.path.getmtime(download) > os.path.getmtime(source_file)):
+            print("Decompressing {} to {}".format(download,source_file))
+            compress_file(download,source_file)
     return downloads
 
-def prepare_entities_of_interest(o,roots,properties,curie_map,query_file):
-    sparql = get_default_sparql_header(curie_map)
-    sparql.append('SELECT ?s ?p ?y WHERE ')
+def entities_of_interest_pattern(roots,properties):
+    sparql = ['SELECT ?s ?p ?y WHERE ']
     sparql.append('{')
     sparql.append('?s rdfs:subClassOf* ?x . ')
     sparql.append('OPTIONAL { ?s rdfs:subClassOf [')
@@ -507,8 +2260,35 @@ def prepare_entities_of_interest(o,roots,properties,curie_map,query_file):
     if properties:
         sparql.append(sparql_in_filter(properties,"p",True))
     sparql.append('}')
+    return sparql
+
+def prepare_entities_of_interest(o,roots,properties,curie_map,query_file):
+    sparql = get_default_sparql_header(curie_map)
+    sparql.extend(entities_of_interest_pattern(roots,properties))
     write_list_to_file(query_file,sparql)
 
+def prepare_seed_terms_query(o,roots,properties,annotation_properties,curie_map,query_file):
+    """
+    :return: Writes a query with a single result column, term, of everything prepare_seed_file would put into
+    the seed: the entities of interest, the properties and fillers of their restrictions and the annotation
+    properties. Its CSV result can be used directly as a ROBOT term file.
+    """
+    sparql = get_default_sparql_header(curie_map)
+    sparql.append('SELECT DISTINCT ?term WHERE ')
+    sparql.append('{')
+    sparql.append('{')
+    sparql.append('{')
+    sparql.extend(entities_of_interest_pattern(roots,properties))
+    sparql.append('}')
+    sparql.append('VALUES ?column { 1 2 3 }')
+    sparql.append('BIND(IF(?column = 1, ?s, IF(?column = 2, ?p, ?y)) AS ?term)')
+    sparql.append('}')
+    if annotation_properties:
+        sparql.append('UNION')
+        sparql.append('{{ VALUES ?term {{ {} }} }}'.format(" ".join(annotation_properties)))
+    sparql.append('FILTER(bound(?term))')
+    sparql.append('}')
+    write_list_to_file(query_file,sparql)
 
 def prepare_ttl_biolink_relations(o,biolink_relations,curie_map,ttl_file):
     ttl = ['@prefix : <http://ontology-kg-preprocessing-kit.org/inject/{}_biolink_relations.owl> . '.format(o)]
@@ -566,6 +2346,47 @@ def get_default_sparql_header(curie_map):
         sparql.append('prefix {}: <{}>'.format(curie,curie_map.get(curie)))
     return sparql
 
+def get_shard_filter(variable, shard, shards):
+    """
+    :param variable: Query variable the results are partitioned by, without the ?
+    :param shard: Index of the shard, from 0 to shards - 1
+    :param shards: Number of shards, at most 256
+    :return: SPARQL FILTER that selects the results of shard: those whose value of variable has an MD5 hash
+    starting with one of the hex digits assigned to the shard. Every value falls into exactly one shard.
+    """
+    if shards < 1 or shards > 256:
+        raise ValueError("The number of shards must be between 1 and 256, not {}".format(shards))
+    digits = 1 if shards <= 16 else 2
+    buckets = ['"{:0{}x}"'.format(b, digits) for b in range(16 ** digits) if b % shards == shard]
+    return "FILTER(SUBSTR(MD5(STR(?{})),1,{}) IN ({}))".format(variable, digits, ", ".join(buckets))
+
+def prepare_sharded_queries(queries, variables, shards, query_dir):
+    """
+    :param queries: List of (sparql_query, query_result, format) tuples, like the KGX queries
+    :param variables: The variable every query is partitioned by, like the IRI of the node or the subject of the edge
+    :param shards: Number of shards
+    :param query_dir: Directory the sharded queries are written to
+    :return: For every shard, the list of (sparql_query, query_result, format) of the sharded queries. The shard
+    filter is added at the end of the WHERE clause of each query, and the results are written next to the
+    results of the unsharded query, with a _shardN suffix.
+    """
+    sharded = []
+    for shard in range(shards):
+        shard_queries = []
+        for (sparql_query, query_result, format), variable in zip(queries, variables):
+            with open(sparql_query, 'r') as f:
+                sparql = f.read()
+            end = sparql.rindex("}")
+            sparql = sparql[:end] + get_shard_filter(variable, shard, shards) + "\n" + sparql[end:]
+            name, _ = os.path.splitext(os.path.basename(sparql_query))
+            shard_query = os.path.join(query_dir, "{}_shard{}.sparql".format(name, shard))
+            with open(shard_query, 'w') as f:
+                f.write(sparql)
+            result, extension = os.path.splitext(query_result)
+            shard_queries.append((shard_query, "{}_shard{}{}".format(result, shard, extension), format))
+        sharded.append(shard_queries)
+    return sharded
+
 def prepare_sparql_count_object_properties(o,roots,curie_map,query_file):
     sparql = get_default_sparql_header(curie_map)
     sparql.append('SELECT ?p (COUNT(?p) as ?pCount) WHERE ')
@@ -597,13 +2418,1116 @@ def prepare_sparql_count_annotation_properties(o,roots,curie_map,query_file):
     sparql.append('GROUP BY ?p ')
     write_list_to_file(query_file,sparql)
 
-def prepare_seed_file(o_seed_table,annotation_properties,o_seed):
-    seed_df = pd.read_csv(o_seed_table)
-    seed_list = []
-    seed_list.extend(seed_df['s'].to_list())
-    seed_list.extend(seed_df['p'].to_list())
-    seed_list.extend(seed_df['y'].to_list())
-    seed_list = list(set(seed_list))
-    for p in annotation_properties:
-        seed_list.append(p)
-    write_list_to_file(o_seed,seed_list)
+def write_seed_terms(terms, seed_file, sort=False):
+    """
+    :param terms: Iterable of terms, possibly with duplicates and empty values
+    :param seed_file: Output file with one term per line
+    :param sort: If True, the terms are written in sorted order, so that seeds of different runs can be diffed.
+    Otherwise every term is written as soon as it is first seen, in the order of terms.
+    :return: Number of distinct terms written. Terms are deduplicated with a set of interned strings, so memory
+    use depends on the number of distinct terms, not on the number of rows they are read from.
+    """
+    seen = set()
+    with atomic_output(seed_file) as tmp, open(tmp, 'w') as f:
+        for term in terms:
+            if not term or term in seen:
+                continue
+            term = sys.intern(term)
+            seen.add(term)
+            if not sort:
+                f.write(term + "\n")
+        if sort:
+            for term in sorted(seen):
+                f.write(term + "\n")
+    return len(seen)
+
+def iter_csv_columns(csv_file, columns, delimiter=','):
+    """
+    :return: Generator of the values of columns (by header name) of all rows of csv_file, row by row. Columns
+    that are missing from the header are ignored.
+    """
+    with open_text(csv_file) as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, None) or []
+        indices = [header.index(column) for column in columns if column in header]
+        for row in reader:
+            for i in indices:
+                if i < len(row):
+                    yield row[i].strip()
+
+def prepare_seed_file(o_seed_table,annotation_properties,o_seed,sort=False):
+    """
+    :param o_seed_table: Result of the entities of interest query, with the columns s, p and y
+    :param annotation_properties: Annotation properties that are always added to the seed
+    :param o_seed: Output seed file
+    :param sort: If True, the seed is written in sorted order
+    """
+    terms = itertools.chain(iter_csv_columns(o_seed_table,['s','p','y']),annotation_properties)
+    write_seed_terms(terms,o_seed,sort)
+
+# Prefixes that are always contracted, unless curie_map maps them differently
+DEFAULT_CURIE_MAP = {
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+    'biolink': 'https://w3id.org/biolink/vocab/',
+    'dce': 'http://purl.org/dc/elements/1.1/',
+    'EFO': 'http://www.ebi.ac.uk/efo/EFO_'
+}
+
+# Namespaces of IRIs of the form <namespace>PREFIX_LOCALID, which are contracted to PREFIX:LOCALID
+OBO_STYLE_NAMESPACES = ['http://purl.obolibrary.org/obo/', 'http://www.orpha.net/ORDO/']
+
+class okpk_curie_trie:
+    """
+    Contracts IRIs to CURIEs by longest prefix match against a character trie of the curie_map. IRIs in the
+    OBO-style namespaces without a more specific prefix are contracted by replacing underscores with colons,
+    like HP_0000118 to HP:0000118. IRIs without a matching prefix are returned unchanged.
+    """
+    # IRIs repeat across the rows of a table, the most recent contractions are kept
+    cache_size = 1 << 16
+
+    def __init__(self, curie_map=None):
+        self.root = dict()
+        self.contract = functools.lru_cache(maxsize=self.cache_size)(self._contract)
+        for namespace in OBO_STYLE_NAMESPACES:
+            self.add(namespace, None)
+        prefixes = dict(DEFAULT_CURIE_MAP)
+        if curie_map:
+            prefixes.update(curie_map)
+        for prefix, namespace in prefixes.items():
+            self.add(str(namespace), prefix)
+
+    def add(self, namespace, prefix):
+        node = self.root
+        for c in namespace:
+            node = node.setdefault(c, dict())
+        node[None] = prefix
+
+    def _contract(self, iri):
+        node = self.root
+        match = None
+        for i, c in enumerate(iri):
+            node = node.get(c)
+            if node is None:
+                break
+            if None in node:
+                match = (i + 1, node[None])
+        curie = iri
+        if match and match[0] < len(iri):
+            local = iri[match[0]:]
+            if match[1] is None:
+                curie = local.replace("_", ":")
+            else:
+                curie = "{}:{}".format(match[1], local)
+        return curie
+
+    def contract_biolink(self, iri):
+        """
+        :return: CURIE of a biolink category or edge label. Like the KGX queries always did, all underscores are
+        replaced with colons, for example biolink:has_phenotype becomes biolink:has:phenotype.
+        """
+        return self.contract(iri).replace("_", ":")
+
+# KGX columns with biolink categories and edge labels, contracted with okpk_curie_trie.contract_biolink
+KGX_BIOLINK_COLUMNS = ('category', 'edge_label')
+
+def contract_iris_in_csv(csv_in, csv_out, columns, curie_trie):
+    """
+    :param csv_in: CSV file with IRIs, like a ROBOT query result
+    :param csv_out: Output CSV file
+    :param columns: Names of the columns whose values are contracted to CURIEs
+    :param curie_trie: okpk_curie_trie used to contract IRIs
+    :return: Rewrites csv_in to csv_out row by row, contracting the IRIs in columns.
+    """
+    with atomic_output(csv_out) as tmp, open_text(csv_in) as f_in, open_text(tmp, 'w') as f_out:
+        reader = csv.reader(f_in)
+        writer = csv.writer(f_out)
+        header = next(reader, None)
+        if header is None:
+            return
+        writer.writerow(header)
+        indices = [(i, curie_trie.contract_biolink if column in KGX_BIOLINK_COLUMNS else curie_trie.contract)
+                   for i, column in enumerate(header) if column in columns]
+        for row in reader:
+            for i, contract in indices:
+                if i < len(row) and row[i]:
+                    row[i] = contract(row[i])
+            writer.writerow(row)
+
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+RDFS_NS = 'http://www.w3.org/2000/01/rdf-schema#'
+OWL_NS = 'http://www.w3.org/2002/07/owl#'
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+BIOLINK_NS = 'https://w3id.org/biolink/vocab/'
+IAO_DEFINITION = 'http://purl.obolibrary.org/obo/IAO_0000115'
+XSD_STRING = 'http://www.w3.org/2001/XMLSchema#string'
+
+# File extension of every output compression
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+def get_compression(path):
+    """
+    :return: gzip or zstd if path has the extension of a compressed file, otherwise None.
+    """
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+def _zstandard():
+    if zstandard is None:
+        raise Exception("Reading or writing zstd compressed files requires the zstandard package (pip install zstandard)")
+    return zstandard
+
+def open_input(path):
+    compression = get_compression(path)
+    if compression == "gzip":
+        return gzip.open(path, 'rb')
+    if compression == "zstd":
+        return _zstandard().open(path, 'rb')
+    return open(path, 'rb')
+
+def open_text(path, mode='r'):
+    """
+    :param path: Text file, gzip compressed if it ends in .gz and zstd compressed if it ends in .zst
+    :param mode: r or w
+    :return: Text file object, without newline translation as the csv module expects, that compresses or
+    decompresses while it is written or read.
+    """
+    compression = get_compression(path)
+    if compression == "gzip":
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='', compresslevel=6)
+    if compression == "zstd":
+        return _zstandard().open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+def get_tmp_path(path):
+    """
+    :return: Temporary path next to path, with the same extension, for files that are written and then renamed.
+    """
+    return os.path.join(os.path.dirname(path), ".tmp." + os.path.basename(path))
+
+def compress_file(file_in, file_out, block_size=1024 * 1024):
+    """
+    :return: Copies file_in to file_out in blocks, compressing or decompressing according to the extensions of
+    both files.
+    """
+    compression = get_compression(file_out)
+    tmp = get_tmp_path(file_out)
+    with open_input(file_in) as f_in:
+        if compression == "gzip":
+            f_out = gzip.open(tmp, 'wb', compresslevel=6)
+        elif compression == "zstd":
+            f_out = _zstandard().open(tmp, 'wb')
+        else:
+            f_out = open(tmp, 'wb')
+        with f_out:
+            shutil.copyfileobj(f_in, f_out, block_size)
+    os.replace(tmp, file_out)
+
+def _rdfxml_tag(tag):
+    if tag.startswith("{"):
+        return tag[1:].replace("}", "", 1)
+    return tag
+
+def _xml_literal(elem, prefixes, declared=()):
+    """
+    :param elem: Element with the content of an rdf:parseType="Literal" property
+    :param prefixes: Namespace to prefix map of the document
+    :return: The content of elem as exclusive canonical XML, like the rdf:XMLLiteral lexical form of RDF/XML
+    parsers: namespaces are declared on the outermost elements that use them.
+    """
+    content = [escape(elem.text or "")]
+    for child in elem:
+        child_declared = set(declared)
+        declarations = []
+        def qname(tag, element):
+            uri, _, local = tag[1:].partition("}") if tag.startswith("{") else ("", "", tag)
+            prefix = prefixes.get(uri, "")
+            if (uri or element) and uri not in child_declared:
+                declarations.append(('xmlns:' + prefix if prefix else 'xmlns', uri))
+                child_declared.add(uri)
+            return "{}:{}".format(prefix, local) if prefix else local
+        name = qname(child.tag, True)
+        attributes = sorted((qname(attribute, False), value) for attribute, value in child.attrib.items())
+        attributes = sorted(declarations) + attributes
+        content.append("<{}{}>".format(name, "".join(' {}="{}"'.format(a, escape(v, {'"': '&quot;'})) for a, v in attributes)))
+        content.append(_xml_literal(child, prefixes, child_declared))
+        content.append("</{}>".format(name))
+        content.append(escape(child.tail or ""))
+    return "".join(content)
+
+def iter_rdfxml_triples(path):
+    """
+    :param path: RDF/XML file, like the OWL files written by ROBOT
+    :return: Generator of (subject, predicate, object, literal) tuples, read in a single streaming pass.
+    Blank nodes are returned as _:id, literals as their lexical form. literal is False for IRIs and blank nodes
+    and a (language, datatype) tuple for literals, with empty strings for a missing language or datatype (and for
+    xsd:string), so that literals that only differ in their language or datatype stay distinct. The content of
+    rdf:parseType="Literal" properties is a single rdf:XMLLiteral. Elements are discarded as soon as their
+    triples have been returned, so memory use does not grow with the size of the file.
+    """
+    rdf_about = '{' + RDF_NS + '}about'
+    rdf_id = '{' + RDF_NS + '}ID'
+    rdf_node_id = '{' + RDF_NS + '}nodeID'
+    rdf_resource = '{' + RDF_NS + '}resource'
+    rdf_parse_type = '{' + RDF_NS + '}parseType'
+    rdf_description = RDF_NS + 'Description'
+    rdf_datatype = '{' + RDF_NS + '}datatype'
+    xml_lang = '{' + XML_NS + '}lang'
+    syntax_attributes = set([rdf_about, rdf_id, rdf_node_id, rdf_resource, rdf_parse_type, rdf_datatype])
+    base = ""
+    bnodes = [0]
+    stack = []
+    root = None
+
+    def new_bnode():
+        bnodes[0] += 1
+        return "_:okpk{}".format(bnodes[0])
+
+    def resolve(iri):
+        if base and ':' not in iri:
+            return urllib.parse.urljoin(base, iri)
+        return iri
+
+    namespaces = dict()
+    with open_input(path) as f:
+        for event, elem in ElementTree.iterparse(f, events=('start', 'end', 'start-ns')):
+            if event == 'start-ns':
+                namespaces[elem[1]] = elem[0]
+                continue
+            if event == 'start':
+                if root is None:
+                    root = elem
+                    base = elem.attrib.get('{' + XML_NS + '}base', "")
+                    stack.append({'type': 'root', 'lang': elem.attrib.get(xml_lang, "")})
+                    continue
+                parent = stack[-1]
+                if parent['type'] in ('xml', 'property') and parent.get('mode') in ('literal', 'xml'):
+                    # Content of an XML literal, which is returned as a whole when the property ends
+                    stack.append({'type': 'xml', 'mode': 'xml'})
+                    continue
+                tag = _rdfxml_tag(elem.tag)
+                lang = elem.attrib.get(xml_lang, parent['lang'])
+                if parent['type'] == 'root' or (parent['type'] == 'property' and parent['mode'] in ('normal', 'collection')):
+                    if rdf_about in elem.attrib:
+                        subject = sys.intern(resolve(elem.attrib[rdf_about]))
+                    elif rdf_id in elem.attrib:
+                        subject = sys.intern(resolve("#" + elem.attrib[rdf_id]))
+                    elif rdf_node_id in elem.attrib:
+                        subject = "_:" + elem.attrib[rdf_node_id]
+                    else:
+                        subject = new_bnode()
+                    if tag != rdf_description:
+                        yield (subject, RDF_NS + 'type', sys.intern(tag), False)
+                    for attribute, value in elem.attrib.items():
+                        if attribute not in syntax_attributes and not attribute.startswith('{' + XML_NS + '}'):
+                            yield (subject, sys.intern(_rdfxml_tag(attribute)), value, (lang, ""))
+                    if parent['type'] == 'property':
+                        if parent['mode'] == 'collection':
+                            parent['items'].append(subject)
+                        else:
+                            parent['object'] = subject
+                    stack.append({'type': 'node', 'subject': subject, 'lang': lang})
+                else:
+                    subject = parent['subject']
+                    predicate = sys.intern(tag)
+                    frame = {'type': 'property', 'subject': subject, 'predicate': predicate, 'mode': 'normal', 'object': None, 'lang': lang}
+                    parse_type = elem.attrib.get(rdf_parse_type)
+                    if rdf_resource in elem.attrib:
+                        yield (subject, predicate, sys.intern(resolve(elem.attrib[rdf_resource])), False)
+                        frame['mode'] = 'done'
+                    elif rdf_node_id in elem.attrib:
+                        yield (subject, predicate, "_:" + elem.attrib[rdf_node_id], False)
+                        frame['mode'] = 'done'
+                    elif parse_type == 'Resource':
+                        frame['mode'] = 'resource'
+                        frame['subject'] = new_bnode()
+                        yield (subject, predicate, frame['subject'], False)
+                    elif parse_type == 'Collection':
+                        frame['mode'] = 'collection'
+                        frame['items'] = []
+                    elif parse_type == 'Literal':
+                        frame['mode'] = 'literal'
+                    stack.append(frame)
+            else:
+                frame = stack.pop()
+                if frame['type'] in ('root', 'xml'):
+                    continue
+                if frame['type'] == 'property':
+                    subject = frame['subject']
+                    predicate = frame['predicate']
+                    if frame['mode'] == 'normal':
+                        if frame['object'] is not None:
+                            yield (subject, predicate, frame['object'], False)
+                        else:
+                            datatype = resolve(elem.attrib[rdf_datatype]) if rdf_datatype in elem.attrib else ""
+                            if datatype:
+                                literal = ("", "" if datatype == XSD_STRING else sys.intern(datatype))
+                            else:
+                                literal = (frame['lang'], "")
+                            yield (subject, predicate, elem.text or "", literal)
+                    elif frame['mode'] == 'literal':
+                        yield (subject, predicate, _xml_literal(elem, namespaces), ("", RDF_NS + 'XMLLiteral'))
+                    elif frame['mode'] == 'collection':
+                        items = frame['items']
+                        if not items:
+                            yield (subject, predicate, RDF_NS + 'nil', False)
+                        else:
+                            cells = [new_bnode() for _ in items]
+                            yield (subject, predicate, cells[0], False)
+                            for i, item in enumerate(items):
+                                yield (cells[i], RDF_NS + 'first', item, False)
+                                yield (cells[i], RDF_NS + 'rest', cells[i + 1] if i + 1 < len(cells) else RDF_NS + 'nil', False)
+                elif stack[-1]['type'] == 'root':
+                    root.clear()
+
+OFN_DEFAULT_PREFIXES = {
+    'owl:': OWL_NS,
+    'rdf:': RDF_NS,
+    'rdfs:': RDFS_NS,
+    'xsd:': 'http://www.w3.org/2001/XMLSchema#',
+    'xml:': XML_NS + '#',
+}
+
+# OWL functional syntax tokens: full IRIs, quoted literals, punctuation, language tags, comments and words
+# (keywords, prefixed names and blank nodes)
+_OFN_TOKEN = re.compile(r'\s*(?:(<[^>]*>)|("(?:[^"\\]|\\.)*")|(\^\^|[()=])|(@[A-Za-z][A-Za-z0-9-]*)|(#[^\n]*)|([^\s()<>"=^@#][^\s()<>"=^]*))', re.S)
+_OFN_TOKEN_KINDS = [None, 'iri', 'literal', 'punctuation', 'language', 'comment', 'word']
+
+class _ofn_tokens:
+    """
+    Streaming tokenizer of an OWL functional syntax file with one token of lookahead. Lines are only joined
+    while a literal spans several lines.
+    """
+    def __init__(self, f):
+        self.lines = iter(f)
+        self.buffer = ""
+        self.pending = []
+        self.lookahead = None
+
+    def _fill(self):
+        while not self.pending:
+            pos = 0
+            while True:
+                m = _OFN_TOKEN.match(self.buffer, pos)
+                if m is None or m.end() == pos:
+                    break
+                pos = m.end()
+                if m.lastindex != 5:
+                    self.pending.append((_OFN_TOKEN_KINDS[m.lastindex], m.group(m.lastindex)))
+            self.buffer = self.buffer[pos:].lstrip()
+            if self.pending:
+                break
+            line = next(self.lines, None)
+            if line is None:
+                if self.buffer:
+                    raise Exception("Unexpected end of functional syntax input: " + self.buffer[:100])
+                return False
+            self.buffer += line if isinstance(line, str) else line.decode('utf-8')
+        self.pending.reverse()
+        return True
+
+    def peek(self):
+        if self.lookahead is None and (self.pending or self._fill()):
+            self.lookahead = self.pending.pop()
+        return self.lookahead
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise Exception("Unexpected end of functional syntax input")
+        self.lookahead = None
+        return token
+
+    def expect(self, text):
+        token = self.next()
+        if token[1] != text:
+            raise Exception("Expected {} in functional syntax input, found {}".format(text, token[1]))
+
+def _read_ofn_term(tokens, prefixes):
+    """
+    :return: The next term: an IRI as a string, a literal as a ('literal', value, (language, datatype)) tuple,
+    like the literals of iter_rdfxml_triples, or an expression or axiom as a list of its name followed by its
+    arguments.
+    """
+    kind, text = tokens.next()
+    if kind == 'iri':
+        return sys.intern(text[1:-1])
+    if kind == 'literal':
+        value = re.sub(r'\\(["\\])', r'\1', text[1:-1])
+        token = tokens.peek()
+        literal = ("", "")
+        if token is not None and token[1] == '^^':
+            tokens.next()
+            datatype = _read_ofn_term(tokens, prefixes)
+            literal = ("", "" if datatype == XSD_STRING else datatype)
+        elif token is not None and token[0] == 'language':
+            literal = (tokens.next()[1][1:], "")
+        return ('literal', value, literal)
+    if kind == 'word':
+        token = tokens.peek()
+        if token is not None and token[1] == '(':
+            tokens.next()
+            term = [text]
+            while tokens.peek()[1] != ')':
+                term.append(_read_ofn_term(tokens, prefixes))
+            tokens.next()
+            return term
+        if text.startswith('_:'):
+            return text
+        i = text.find(':')
+        if i >= 0 and text[:i + 1] in prefixes:
+            return sys.intern(prefixes[text[:i + 1]] + text[i + 1:])
+        return text
+    raise Exception("Unexpected {} in functional syntax input".format(text))
+
+def _ofn_class_expression(expression, new_bnode):
+    if not isinstance(expression, list):
+        return expression
+    node = new_bnode()
+    if expression[0] in ('ObjectSomeValuesFrom', 'ObjectAllValuesFrom') and len(expression) == 3:
+        yield (node, RDF_NS + 'type', OWL_NS + 'Restriction', False)
+        p = expression[1] if not isinstance(expression[1], list) else new_bnode()
+        yield (node, OWL_NS + 'onProperty', p, False)
+        filler = yield from _ofn_class_expression(expression[2], new_bnode)
+        values_from = 'someValuesFrom' if expression[0] == 'ObjectSomeValuesFrom' else 'allValuesFrom'
+        yield (node, OWL_NS + values_from, filler, False)
+    else:
+        yield (node, RDF_NS + 'type', OWL_NS + 'Class', False)
+    return node
+
+OFN_DECLARATION_TYPES = {
+    'Class': OWL_NS + 'Class',
+    'ObjectProperty': OWL_NS + 'ObjectProperty',
+    'DataProperty': OWL_NS + 'DatatypeProperty',
+    'AnnotationProperty': OWL_NS + 'AnnotationProperty',
+    'NamedIndividual': OWL_NS + 'NamedIndividual',
+    'Datatype': RDFS_NS + 'Datatype',
+}
+
+def _ofn_axiom_triples(axiom, new_bnode):
+    name = axiom[0]
+    args = [a for a in axiom[1:] if not (isinstance(a, list) and a[0] == 'Annotation')]
+    if name == 'Declaration' and isinstance(args[0], list) and args[0][0] in OFN_DECLARATION_TYPES:
+        yield (args[0][1], RDF_NS + 'type', OFN_DECLARATION_TYPES[args[0][0]], False)
+    elif name == 'AnnotationAssertion' and len(args) == 3:
+        p, s, o = args
+        if isinstance(o, tuple):
+            yield (s, p, o[1], o[2])
+        else:
+            yield (s, p, o, False)
+    elif name == 'SubClassOf' and len(args) == 2:
+        s = yield from _ofn_class_expression(args[0], new_bnode)
+        o = yield from _ofn_class_expression(args[1], new_bnode)
+        yield (s, RDFS_NS + 'subClassOf', o, False)
+    elif name == 'EquivalentClasses':
+        nodes = []
+        for expression in args:
+            node = yield from _ofn_class_expression(expression, new_bnode)
+            nodes.append(node)
+        for i in range(len(nodes) - 1):
+            yield (nodes[i], OWL_NS + 'equivalentClass', nodes[i + 1], False)
+    elif name in ('SubObjectPropertyOf', 'SubAnnotationPropertyOf', 'SubDataPropertyOf') and len(args) == 2:
+        if not isinstance(args[0], list) and not isinstance(args[1], list):
+            yield (args[0], RDFS_NS + 'subPropertyOf', args[1], False)
+    elif name == 'ClassAssertion' and len(args) == 2:
+        o = yield from _ofn_class_expression(args[0], new_bnode)
+        yield (args[1], RDF_NS + 'type', o, False)
+    elif name == 'ObjectPropertyAssertion' and len(args) == 3 and not isinstance(args[0], list):
+        yield (args[1], args[0], args[2], False)
+
+def iter_ofn_triples(path):
+    """
+    :param path: OWL functional syntax file, optionally gzipped, like the intermediate ontologies written with
+    intermediate_format: ofn
+    :return: Generator of (subject, predicate, object, literal) tuples, like iter_rdfxml_triples, of the RDF
+    mapping of declarations, annotation assertions, subclass, equivalence and sub-property axioms and class and
+    object property assertions. Class expressions other than existential and universal restrictions are
+    returned as blank nodes of type owl:Class without their content, and axiom annotations are skipped, which is
+    all the native KGX export and the closure index read. Axioms are read one at a time.
+    """
+    prefixes = dict(OFN_DEFAULT_PREFIXES)
+    bnodes = [0]
+
+    def new_bnode():
+        bnodes[0] += 1
+        return "_:okpk{}".format(bnodes[0])
+
+    with open_input(path) as f:
+        tokens = _ofn_tokens(f)
+        while tokens.peek() is not None:
+            kind, text = tokens.next()
+            if text == 'Prefix':
+                tokens.expect('(')
+                prefix = tokens.next()[1]
+                tokens.expect('=')
+                prefixes[prefix] = tokens.next()[1][1:-1]
+                tokens.expect(')')
+            elif text == 'Ontology':
+                tokens.expect('(')
+                first = True
+                while tokens.peek()[1] != ')':
+                    term = _read_ofn_term(tokens, prefixes)
+                    if isinstance(term, list):
+                        if term[0] != 'Import':
+                            yield from _ofn_axiom_triples(term, new_bnode)
+                    elif first:
+                        yield (term, RDF_NS + 'type', OWL_NS + 'Ontology', False)
+                    first = False
+                tokens.next()
+            else:
+                raise Exception("Unexpected {} in functional syntax file {}".format(text, path))
+
+def iter_owl_triples(path):
+    """
+    :param path: RDF/XML or, if the file name ends in .ofn or .ofn.gz, OWL functional syntax ontology
+    :return: Generator of (subject, predicate, object, literal) tuples of path
+    """
+    if path.endswith(".ofn") or path.endswith(".ofn.gz"):
+        return iter_ofn_triples(path)
+    return iter_rdfxml_triples(path)
+
+def _write_kgx_csv(csv_out, header, rows):
+    with atomic_output(csv_out) as tmp, open_text(tmp, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+
+def export_kgx_native(owl_file, nodes_csv, edges_relations_csv, edges_cl_csv, annotations_csv, curie_trie):
+    """
+    :param owl_file: RDF/XML or functional syntax ontology with biolink categories and relations, like the biolink
+    ontology of the pipeline
+    :param nodes_csv: Output KGX nodes file
+    :param edges_relations_csv: Output KGX edges file for existential restrictions (subClassOf R some B)
+    :param edges_cl_csv: Output KGX edges file for subClassOf and equivalentTo between named classes
+    :param annotations_csv: Output KGX annotations file
+    :param curie_trie: okpk_curie_trie used to contract IRIs
+    :return: Writes the same KGX rows as the kgx_*.sparql queries followed by CURIE contraction, reading
+    owl_file only once. The order of query results is not defined, so rows are sorted instead, which makes the
+    output deterministic but not byte-identical to the SPARQL path.
+    """
+    rdf_type = RDF_NS + 'type'
+    subclass_of = RDFS_NS + 'subClassOf'
+    equivalent_class = OWL_NS + 'equivalentClass'
+    on_property = OWL_NS + 'onProperty'
+    some_values_from = OWL_NS + 'someValuesFrom'
+    label = RDFS_NS + 'label'
+    category = BIOLINK_NS + 'category'
+    relation = BIOLINK_NS + 'relation'
+
+    classes = set()
+    annotation_properties = set()
+    restrictions = set()
+    restriction_properties = dict()
+    restriction_fillers = dict()
+    restriction_edges = []
+    class_edges = set()
+    edge_labels = dict()
+    annotations = dict()
+
+    for s, p, o, is_literal in iter_owl_triples(owl_file):
+        if p == rdf_type:
+            if o == OWL_NS + 'Class':
+                classes.add(s)
+            elif o == OWL_NS + 'AnnotationProperty':
+                annotation_properties.add(s)
+            elif o == OWL_NS + 'Restriction':
+                restrictions.add(s)
+        elif s.startswith("_:"):
+            if p == on_property and not is_literal:
+                restriction_properties.setdefault(s, []).append(o)
+            elif p == some_values_from and not is_literal:
+                restriction_fillers.setdefault(s, []).append(o)
+        elif p in (subclass_of, equivalent_class) and not is_literal:
+            if o.startswith("_:"):
+                if p == subclass_of:
+                    restriction_edges.append((s, o))
+            else:
+                class_edges.add((s, p, o))
+        elif is_literal or not o.startswith("_:"):
+            if p == relation:
+                edge_labels.setdefault(s, []).append(o)
+            # Triples are a set, but literals that only differ in their language or datatype are distinct and,
+            # like in the query results, give separate rows with the same value
+            annotations.setdefault(s, set()).add((p, o, is_literal))
+
+    c = curie_trie.contract
+    nodes = []
+    annotation_rows = []
+    for iri in classes:
+        if iri.startswith("_:"):
+            continue
+        values = annotations.get(iri, set())
+        names = [v for p, v, _ in values if p == label] or [""]
+        descriptions = [v for p, v, _ in values if p == IAO_DEFINITION] or [""]
+        categories = [curie_trie.contract_biolink(v) for p, v, _ in values if p == category] or [""]
+        for name in names:
+            for description in descriptions:
+                for cat in categories:
+                    nodes.append((c(iri), name, iri, description, cat))
+        for p, v, _ in values:
+            if p in annotation_properties and p != category:
+                annotation_rows.append((c(iri), c(p), v))
+    _write_kgx_csv(nodes_csv, ['id', 'name', 'iri', 'description', 'category'], sorted(nodes))
+    _write_kgx_csv(annotations_csv, ['id', 'annotation', 'value'], sorted(annotation_rows))
+
+    edges = []
+    for s, r in restriction_edges:
+        if r not in restrictions:
+            continue
+        for p in restriction_properties.get(r, []):
+            for o in restriction_fillers.get(r, []):
+                if p.startswith("_:") or o.startswith("_:"):
+                    continue
+                for el in edge_labels.get(p, [""]):
+                    edges.append((c(s), c(o), c(p), curie_trie.contract_biolink(el) if el else el))
+    _write_kgx_csv(edges_relations_csv, ['subject', 'object', 'relation', 'edge_label'], sorted(edges))
+    edges = [(c(s), c(o), c(p), "") for s, p, o in class_edges]
+    _write_kgx_csv(edges_cl_csv, ['subject', 'object', 'relation', 'edge_label'], sorted(edges))
+
+# Predicates in the RDF, RDFS and OWL vocabularies that are not annotations
+LOGICAL_PREDICATES = set([RDFS_NS + 'subClassOf', RDFS_NS + 'subPropertyOf', RDFS_NS + 'domain', RDFS_NS + 'range'])
+PROPERTY_TYPES = set([OWL_NS + 'ObjectProperty', OWL_NS + 'DatatypeProperty', OWL_NS + 'AnnotationProperty',
+    OWL_NS + 'TransitiveProperty', OWL_NS + 'SymmetricProperty', OWL_NS + 'FunctionalProperty'])
+
+def is_logical_predicate(p):
+    if p in LOGICAL_PREDICATES:
+        return True
+    return (p.startswith(OWL_NS) or p.startswith(RDF_NS)) and p != OWL_NS + 'deprecated'
+
+class okpk_source_fingerprint:
+    """
+    Semantic fingerprint of the source ontologies of a pipeline: for every named entity, a digest of its logical
+    axioms and one of its annotations, with blank node structures (restrictions, class expressions, axiom
+    annotations) inlined. Axioms that belong to no entity (general class axioms, disjointness) share one digest.
+    The ontology header (version IRI, date) is not part of the fingerprint, so a release that only changes the
+    header has the same fingerprint as the previous one.
+    """
+    def __init__(self):
+        self.logical = dict()
+        self.annotations = dict()
+        self.references = dict()
+        self.classes = set()
+        self.properties = set()
+        self.defined = set()
+        self.general_axioms = None
+
+    @staticmethod
+    def build(owl_files):
+        fingerprint = okpk_source_fingerprint()
+        triples = dict()
+        referenced = set()
+        ontologies = set()
+        for i, owl_file in enumerate(owl_files):
+            for s, p, o, is_literal in iter_owl_triples(owl_file):
+                # Blank node ids are only unique within a file
+                if s.startswith("_:"):
+                    s = "_:{}{}".format(i, s[2:])
+                if not is_literal and o.startswith("_:"):
+                    o = "_:{}{}".format(i, o[2:])
+                    referenced.add(o)
+                triples.setdefault(s, []).append((p, o, is_literal))
+                if p == RDF_NS + 'type':
+                    if o == OWL_NS + 'Ontology':
+                        ontologies.add(s)
+                    elif o == OWL_NS + 'Class':
+                        fingerprint.classes.add(s)
+                    elif o in PROPERTY_TYPES:
+                        fingerprint.properties.add(s)
+                elif p == OWL_NS + 'equivalentClass':
+                    for c in (s, o):
+                        if not c.startswith("_:"):
+                            fingerprint.defined.add(c)
+        canonical = dict()
+
+        def canonicalise(node, refs, visiting):
+            if node in canonical:
+                form, node_refs = canonical[node]
+                refs.update(node_refs)
+                return form
+            if node in visiting:
+                return "[cycle]"
+            visiting.add(node)
+            node_refs = set()
+            items = []
+            for p, o, is_literal in triples.get(node, []):
+                if is_literal:
+                    items.append('{} "{}"'.format(p, o))
+                elif o.startswith("_:"):
+                    items.append('{} {}'.format(p, canonicalise(o, node_refs, visiting)))
+                else:
+                    items.append('{} <{}>'.format(p, o))
+                    node_refs.add(o)
+            visiting.discard(node)
+            form = "[" + " ".join(sorted(items)) + "]"
+            canonical[node] = (form, node_refs)
+            refs.update(node_refs)
+            return form
+
+        axiom_annotations = dict()
+        general_axioms = []
+        for s in triples:
+            if not s.startswith("_:") or s in referenced:
+                continue
+            sources = [o for p, o, _ in triples[s] if p == OWL_NS + 'annotatedSource']
+            form = canonicalise(s, set(), set())
+            if sources:
+                axiom_annotations.setdefault(sources[0], []).append(form)
+            else:
+                general_axioms.append(form)
+        fingerprint.general_axioms = hashlib.blake2b("\n".join(sorted(general_axioms)).encode('utf-8'), digest_size=16).hexdigest()
+        for s, entity_triples in triples.items():
+            if s.startswith("_:") or s in ontologies:
+                continue
+            logical = []
+            annotations = list(axiom_annotations.get(s, []))
+            refs = set()
+            for p, o, is_literal in entity_triples:
+                if is_literal:
+                    item = '{} "{}"'.format(p, o)
+                elif o.startswith("_:"):
+                    item = '{} {}'.format(p, canonicalise(o, refs if is_logical_predicate(p) else set(), set()))
+                else:
+                    item = '{} <{}>'.format(p, o)
+                    if is_logical_predicate(p) and p != RDF_NS + 'type':
+                        refs.add(o)
+                (logical if is_logical_predicate(p) else annotations).append(item)
+            fingerprint.logical[s] = hashlib.blake2b("\n".join(sorted(logical)).encode('utf-8'), digest_size=16).hexdigest()
+            fingerprint.annotations[s] = hashlib.blake2b("\n".join(sorted(annotations)).encode('utf-8'), digest_size=16).hexdigest()
+            refs.discard(s)
+            if refs:
+                fingerprint.references[s] = refs
+        return fingerprint
+
+def save_incremental_state(state_file, signature, fingerprint):
+    tmp = state_file + ".tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump((signature, fingerprint), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, state_file)
+
+def plan_incremental_update(state_file, signature, fingerprint, outputs, threshold=0.1):
+    """
+    :param state_file: State saved by save_incremental_state after the last successful run
+    :param signature: Hash of the configuration of the ontology; any change requires a full rebuild
+    :param fingerprint: okpk_source_fingerprint of the current sources
+    :param outputs: Outputs that are patched, which have to exist
+    :param threshold: Maximum fraction of classes that may be affected by the changes
+    :return: (affected, reason): the set of classes whose outputs have to be recomputed, or None and the reason
+    why everything has to be rebuilt. A class is affected if its axioms or annotations changed, or if it
+    references (as superclass, filler or equivalent class) an affected class whose axioms changed, since in EL
+    the entailments of a class only depend on the classes it references. Changes to properties, logical
+    definitions or general axioms can change the entailments of any class, so they require a full rebuild.
+    """
+    if not all(os.path.exists(output) for output in outputs):
+        return None, "no previous outputs"
+    if not os.path.exists(state_file):
+        return None, "no previous state"
+    with open(state_file, 'rb') as f:
+        previous_signature, previous = pickle.load(f)
+    if previous_signature != signature:
+        return None, "the configuration changed"
+    if previous.general_axioms != fingerprint.general_axioms:
+        return None, "general axioms changed"
+    entities = set(previous.logical) | set(fingerprint.logical)
+    changed_logical = set(e for e in entities if previous.logical.get(e) != fingerprint.logical.get(e))
+    changed_annotations = set(e for e in entities if previous.annotations.get(e) != fingerprint.annotations.get(e))
+    changed_properties = (changed_logical | changed_annotations) & (previous.properties | fingerprint.properties)
+    if changed_properties:
+        return None, "{} properties changed".format(len(changed_properties))
+    changed_definitions = changed_logical & (previous.defined | fingerprint.defined)
+    if changed_definitions:
+        return None, "{} logical definitions changed".format(len(changed_definitions))
+    dependents = dict()
+    for e, refs in fingerprint.references.items():
+        for r in refs:
+            dependents.setdefault(r, []).append(e)
+    affected = set(changed_logical)
+    stack = list(changed_logical)
+    while stack:
+        for dependent in dependents.get(stack.pop(), []):
+            if dependent not in affected:
+                affected.add(dependent)
+                stack.append(dependent)
+    affected |= changed_annotations
+    classes = len(fingerprint.classes) or 1
+    if len(affected) > threshold * classes:
+        return None, "{} of {} classes are affected".format(len(affected), classes)
+    return affected, None
+
+def _read_kgx_csv(csv_file):
+    with open_text(csv_file) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        return header, [row for row in reader]
+
+def _read_kgx_header(csv_file):
+    with open_text(csv_file) as f:
+        return next(csv.reader(f), None)
+
+def _iter_kgx_rows(csv_file):
+    with open_text(csv_file) as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            yield row
+
+def patch_kgx_outputs(kgx_files, module_files, affected, roots, curie_trie):
+    """
+    :param kgx_files: KGX nodes, relation edges, class edges and annotations files of the previous run, patched in place
+    :param module_files: The same KGX files exported from the module of the affected classes, or None
+    :param affected: IRIs of the affected classes
+    :param roots: Root CURIEs or IRIs of the ontology, owl:Thing for all classes
+    :param curie_trie: okpk_curie_trie the KGX files were contracted with
+    :return: Replaces all rows of the affected classes with the rows exported from the module, adds rows of
+    classes that the previous files did not contain (new fillers), and then selects the rows of the seed again,
+    like prepare_entities_of_interest and robot_okpk_finish: the descendants of the roots, the fillers and
+    properties of their relations, and the axioms between those. The previous files are streamed, only the
+    module, the ids of the previous rows and the class hierarchy are kept in memory. The rows of the module are
+    written after the rows that are kept.
+    """
+    affected = set(curie_trie.contract(iri) for iri in affected)
+    added = []
+    for i, kgx_file in enumerate(kgx_files):
+        if module_files:
+            known = set(row[0] for row in _iter_kgx_rows(kgx_file))
+            _, module_rows = _read_kgx_csv(module_files[i])
+            added.append(sorted(row for row in module_rows if row[0] in affected or row[0] not in known))
+        else:
+            added.append([])
+
+    def patched(i):
+        kept = (row for row in _iter_kgx_rows(kgx_files[i]) if row[0] not in affected)
+        return itertools.chain(kept, added[i])
+
+    selected = [None] * len(kgx_files)
+    root_curies = set(curie_trie.contract(r) if r.startswith("http") else r for r in roots)
+    if 'owl:Thing' not in root_curies and OWL_THING not in root_curies:
+        children = dict()
+        for row in patched(2):
+            if row[2] == 'rdfs:subClassOf':
+                children.setdefault(row[1], []).append(row[0])
+        descendants = set()
+        stack = list(set(row[0] for row in patched(0) if row[0] in root_curies))
+        while stack:
+            node = stack.pop()
+            if node not in descendants:
+                descendants.add(node)
+                stack.extend(children.get(node, []))
+        del children
+        seed = set(descendants)
+        properties = set()
+        for row in patched(1):
+            if row[0] in descendants:
+                seed.add(row[1])
+                properties.add(row[2])
+        selected = [
+            lambda row: row[0] in seed,
+            lambda row: row[0] in seed and row[1] in seed and row[2] in properties,
+            lambda row: row[0] in seed and row[1] in seed,
+            lambda row: row[0] in seed,
+        ]
+
+    for i, kgx_file in enumerate(kgx_files):
+        rows = patched(i)
+        if selected[i]:
+            rows = filter(selected[i], rows)
+        _write_kgx_csv(kgx_file, _read_kgx_header(kgx_file), rows)
+
+OWL_THING = OWL_NS + 'Thing'
+
+def expand_curie(curie, curie_map):
+    """
+    :param curie: CURIE like HP:0000118, or an IRI, optionally in angle brackets
+    :param curie_map: Dictionary of prefix to namespace
+    :return: The IRI of curie. CURIEs with an unknown prefix are returned unchanged.
+    """
+    if curie.startswith("<") and curie.endswith(">"):
+        return curie[1:-1]
+    if "://" in curie or ":" not in curie:
+        return curie
+    prefix, local = curie.split(":", 1)
+    prefixes = dict(DEFAULT_CURIE_MAP)
+    if curie_map:
+        prefixes.update(curie_map)
+    if prefix in prefixes:
+        return prefixes[prefix] + local
+    return curie
+
+class okpk_closure_index:
+    """
+    Subclass closure index of an ontology, used instead of SPARQL property paths (rdfs:subClassOf*) to select
+    the descendants of the configured roots. IRIs are interned to integer ids, the asserted (reasoned) subclass
+    hierarchy is kept as arrays of child ids, and descendants are computed once per root with a bytearray of
+    visited ids. The index also records the existential restrictions and annotation assertions of every class,
+    which is all the seed, category and count steps need.
+    """
+    def __init__(self):
+        self.iris = []
+        self.ids = dict()
+        self.children = []
+        self.classes = set()
+        self.restrictions = dict()
+        self.annotations = dict()
+        self.annotation_properties = set()
+        self.descendant_cache = dict()
+
+    def id(self, iri):
+        i = self.ids.get(iri)
+        if i is None:
+            i = len(self.iris)
+            self.ids[iri] = i
+            self.iris.append(iri)
+            self.children.append(array('i'))
+        return i
+
+    @staticmethod
+    def build(owl_file):
+        """
+        :param owl_file: RDF/XML or functional syntax ontology, like the enriched ontology of the pipeline
+        :return: okpk_closure_index of owl_file, read in a single streaming pass
+        """
+        index = okpk_closure_index()
+        rdf_type = RDF_NS + 'type'
+        subclass_of = RDFS_NS + 'subClassOf'
+        restriction_properties = dict()
+        restriction_fillers = dict()
+        restriction_edges = []
+        assertions = []
+        for s, p, o, is_literal in iter_owl_triples(owl_file):
+            if s.startswith("_:"):
+                if p == OWL_NS + 'onProperty':
+                    restriction_properties[s] = o
+                elif p == OWL_NS + 'someValuesFrom':
+                    restriction_fillers[s] = o
+                continue
+            if p == rdf_type and not is_literal:
+                if o == OWL_NS + 'Class':
+                    index.classes.add(index.id(s))
+                elif o == OWL_NS + 'AnnotationProperty':
+                    index.annotation_properties.add(index.id(s))
+                continue
+            if p == subclass_of and not is_literal:
+                if o.startswith("_:"):
+                    restriction_edges.append((s, o))
+                else:
+                    index.children[index.id(o)].append(index.id(s))
+                continue
+            assertions.append((s, p))
+        for s, r in restriction_edges:
+            p = restriction_properties.get(r)
+            y = restriction_fillers.get(r)
+            if p and y and not p.startswith("_:") and not y.startswith("_:"):
+                index.restrictions.setdefault(index.id(s), []).append((index.id(p), index.id(y)))
+        for s, p in assertions:
+            pid = index.ids.get(p)
+            if pid is not None and pid in index.annotation_properties:
+                counts = index.annotations.setdefault(index.id(s), dict())
+                counts[pid] = counts.get(pid, 0) + 1
+        return index
+
+    def save(self, path):
+        with atomic_output(path) as tmp, open(tmp, 'wb') as f:
+            pickle.dump((self.iris, self.children, self.classes, self.restrictions, self.annotations, self.annotation_properties), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        index = okpk_closure_index()
+        with open(path, 'rb') as f:
+            index.iris, index.children, index.classes, index.restrictions, index.annotations, index.annotation_properties = pickle.load(f)
+        index.ids = dict((iri, i) for i, iri in enumerate(index.iris))
+        return index
+
+    def descendants(self, root):
+        """
+        :param root: IRI of a class
+        :return: Ids of root and all its (reflexive, transitive) asserted subclasses, like rdfs:subClassOf* in the
+        queries. Reasoned ontologies do not assert subClassOf owl:Thing, so for owl:Thing these are only the
+        classes explicitly asserted below it.
+        """
+        if root in self.descendant_cache:
+            return self.descendant_cache[root]
+        start = self.ids.get(root)
+        found = []
+        if start is not None:
+            visited = bytearray(len(self.iris))
+            visited[start] = 1
+            stack = [start]
+            while stack:
+                i = stack.pop()
+                found.append(i)
+                for child in self.children[i]:
+                    if not visited[child]:
+                        visited[child] = 1
+                        stack.append(child)
+        self.descendant_cache[root] = found
+        return found
+
+    def root(self, curie, curie_map):
+        """
+        :return: IRI of the root (or category root) curie. Raises an exception if its prefix is not in curie_map or
+        it is not in the ontology, where the queries would fail or silently select nothing. owl:Thing, the
+        default root, does not have to be in the ontology.
+        """
+        iri = expand_curie(curie, curie_map)
+        if "://" not in iri:
+            raise Exception("The prefix of root {} is not in the curie_map".format(curie))
+        if iri not in self.ids and iri != OWL_THING:
+            raise Exception("Root {} is not in the ontology".format(curie))
+        return iri
+
+    def write_seed(self, roots, properties, annotation_properties, curie_map, seed_file):
+        """
+        Writes the classes below roots, together with the properties and fillers of their existential
+        restrictions on properties (all properties if properties is empty), and the annotation_properties.
+        """
+        properties = [expand_curie(p, curie_map) for p in properties]
+        property_ids = set([self.ids[p] for p in properties if p in self.ids])
+        seed = set()
+        for root in roots:
+            for s in self.descendants(self.root(root, curie_map)):
+                if self.iris[s].startswith("_:"):
+                    continue
+                seed.add(self.iris[s])
+                for p, y in self.restrictions.get(s, []):
+                    if not properties or p in property_ids:
+                        seed.add(self.iris[p])
+                        seed.add(self.iris[y])
+        seed = sorted(seed)
+        seed.extend(annotation_properties)
+        write_list_to_file(seed_file, seed)
+
+    def write_property_counts(self, roots, curie_map, csv_out, annotation_properties=False):
+        """
+        Writes, for every object property (or annotation property), how often it is used in existential
+        restrictions (or annotation assertions) of the classes below roots, like the count SPARQL queries.
+        """
+        counts = dict()
+        for root in roots:
+            for s in self.descendants(self.root(root, curie_map)):
+                if annotation_properties:
+                    for p, count in self.annotations.get(s, dict()).items():
+                        counts[p] = counts.get(p, 0) + count
+                else:
+                    for p, _ in self.restrictions.get(s, []):
+                        counts[p] = counts.get(p, 0) + 1
+        _write_kgx_csv(csv_out, ['p', 'pCount'], sorted([(self.iris[p], count) for p, count in counts.items()]))
+
+    def write_biolink_categories(self, biolink_categories, curie_map, ttl_file):
+        """
+        Writes a biolink:category assertion for every class below each root in biolink_categories.
+        """
+        ttl = ['@prefix biolink: <https://w3id.org/biolink/vocab/> . ']
+        ttl.append('@prefix owl: <http://www.w3.org/2002/07/owl#> . ')
+        ttl.append('@prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> . ')
+        for curie in curie_map:
+            ttl.append('@prefix {}: <{}> . '.format(curie,curie_map.get(curie)))
+        ttl.append('biolink:category rdf:type owl:AnnotationProperty .')
+        for cl in biolink_categories:
+            for s in self.descendants(self.root(cl, curie_map)):
+                if not self.iris[s].startswith("_:"):
+                    ttl.append("<{}> biolink:category {} .".format(self.iris[s], biolink_categories.get(cl)))
+        write_list_to_file(ttl_file, ttl)
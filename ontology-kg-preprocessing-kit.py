@@ -6,7 +6,7 @@ Created on Fri Apr 17 21:24:37 2020
 @author: Nicolas Matentzoglu, EMBL-EBI
 """
 
-import os, shutil, sys
+import os, shutil, sys, time, json, hashlib
 import ruamel.yaml
 import warnings
 import urllib.request
@@ -20,6 +20,9 @@ from lib import *
 warnings.simplefilter('ignore', ruamel.yaml.error.UnsafeLoaderWarning)
 
 config_file = sys.argv[1]
+# With --resume, the outputs of an interrupted run are kept even if the configuration asks for a clean build, and
+# the build manifests make the run continue after the last completed step of every ontology
+resume = "--resume" in sys.argv[2:]
 print(config_file)
 config = okpk_config(config_file)
 
@@ -42,7 +45,9 @@ sparql_dir = os.path.join(os.environ['SPARQLDIR'])
 cdir(ontology_dir)
 cdir(build_dir)
 
-if config.is_clean_dir():
+if config.is_clean_dir() and resume:
+    print("Resuming, the outputs of completed steps are kept.")
+elif config.is_clean_dir():
     print("Cleanup..")
     shutil.rmtree(ontology_dir)
     os.makedirs(ontology_dir)
@@ -58,16 +63,48 @@ construct_kgx_types_sparql = os.path.join(sparql_dir,"construct_kgx_types.sparql
 
 skip = True
 
+# robot_java_args in the configuration takes precedence over the ROBOT_JAVA_ARGS environment variable
+if config.get_robot_java_args():
+    os.environ['ROBOT_JAVA_ARGS'] = config.get_robot_java_args()
+java_args = os.environ.get('ROBOT_JAVA_ARGS')
+# With the heap planner, the heap of every invocation is chosen separately and concurrent invocations wait for
+# the memory budget, so the number of workers is not capped by a fixed heap
+worker_java_args = java_args
+if config.is_robot_heap_planner():
+    start_heap_planner(config.get_robot_heap_history() or os.path.join(build_dir,"heap_history.json"),java_args,
+        config.get_robot_min_heap(),config.get_robot_max_heap(),config.get_robot_memory_budget(),os.path.join(build_dir,"memory_budget.json"))
+    worker_java_args = None
+
+# External programs stream their output into a log file per ontology and step, or tagged to the console
+start_process_manager(config.get_process_logs(),config.get_max_parallel_processes(),config.get_progress_interval())
+
+robot_server = config.get_robot_server()
+if robot_server and config.is_robot_heap_planner():
+    print("robot_server is not used with robot_heap_planner, every ROBOT command runs its own process.")
+elif robot_server:
+    start_robot_server(robot_server.get("classpath"),robot_server.get("port",2113),java_args,robot_server.get("main_class","com.facebook.nailgun.NGServer"))
+robot_version = get_robot_version()
+
+download_cache = okpk_download_cache(config.get_download_cache(),config.is_offline())
+step_cache = okpk_step_cache(config.get_step_cache(),robot_version) if config.get_step_cache() else None
+print("Fetching sources...")
+failed_sources = prefetch_urls([s for o in config.get_ontologies() for s in config.get_sources(o)],download_cache,config.get_max_parallel_downloads())
+if failed_sources:
+    print("{} sources could not be fetched, they are retried by the download step of their ontologies.".format(len(failed_sources)))
+
 print("Preprocessing ontologies for easy ingestion into knowledge graphs")
 
-for o in config.get_ontologies():
+def process_ontology(o):
     print("Preparing configuration {}...".format(o))
     o_build_dir = os.path.join(build_dir,o)
     o_ontology_dir = os.path.join(ontology_dir,o)
+    o_ext = config.get_intermediate_extension()
     o_role_chains = os.path.join(o_build_dir,"role_chains_{}.owl".format(o))
     o_seed_table = os.path.join(o_build_dir,"seed_{}.csv".format(o))
     o_seed = os.path.join(o_build_dir,"seed_{}.txt".format(o))
     o_seed_sparql = os.path.join(o_build_dir,"seed_{}.sparql".format(o))
+    o_seed_terms_sparql = os.path.join(o_build_dir,"seed_terms_{}.sparql".format(o))
+    o_seed_terms = os.path.join(o_build_dir,"seed_terms_{}.csv".format(o))
     o_biolink_sparql = os.path.join(o_build_dir,"biolink_{}.sparql".format(o))
     o_biolink_category_ttl  = os.path.join(o_build_dir,"biolink_categories_{}.ttl".format(o))
     o_biolink_relations_ttl  = os.path.join(o_build_dir,"biolink_relations_{}.ttl".format(o))
@@ -76,14 +113,14 @@ for o in config.get_ontologies():
     o_count_annotation_properties_sparql = os.path.join(o_build_dir,"count_annotation_properties_{}.sparql".format(o))
     o_count_object_properties_csv = os.path.join(o_ontology_dir,"count_object_properties_{}.csv".format(o))
     o_count_annotation_properties_csv = os.path.join(o_ontology_dir,"count_annotation_properties_{}.csv".format(o))
-    o_enriched = os.path.join(o_build_dir,"{}_enriched.owl".format(o))
-    o_reduced = os.path.join(o_build_dir,"{}_reduced.owl".format(o))
-    o_finished = os.path.join(o_ontology_dir,"{}_finished.owl".format(o))
-    o_biolink = os.path.join(o_build_dir,"{}_biolink.owl".format(o))
-    o_kg_json = os.path.join(o_ontology_dir,"{}_kg.json".format(o))
-    o_kg_nodes_tsv = os.path.join(o_ontology_dir,"kgx_{}_nodes.csv".format(o))
-    o_kg_edges_tsv = os.path.join(o_ontology_dir,"kgx_{}_edges.csv".format(o))
-    o_kg_annotations_tsv = os.path.join(o_ontology_dir,"kgx_{}_annotations.csv".format(o))
+    o_enriched = os.path.join(o_build_dir,"{}_enriched{}".format(o,o_ext))
+    o_reduced = os.path.join(o_build_dir,"{}_reduced{}".format(o,o_ext))
+    o_finished = os.path.join(o_ontology_dir,"{}_finished{}".format(o,o_ext))
+    o_biolink = os.path.join(o_build_dir,"{}_biolink{}".format(o,o_ext))
+    o_kg_json = os.path.join(o_ontology_dir,"{}_kg.json{}".format(o,config.get_output_extension("json")))
+    o_kg_nodes_tsv = os.path.join(o_ontology_dir,"kgx_{}_nodes.csv{}".format(o,config.get_output_extension("nodes")))
+    o_kg_edges_tsv = os.path.join(o_ontology_dir,"kgx_{}_edges.csv{}".format(o,config.get_output_extension("edges")))
+    o_kg_annotations_tsv = os.path.join(o_ontology_dir,"kgx_{}_annotations.csv{}".format(o,config.get_output_extension("annotations")))
     
     cdir(o_build_dir)
     cdir(o_ontology_dir)
@@ -98,50 +135,212 @@ for o in config.get_ontologies():
     prepare_sparql_count_object_properties(o,o_roots,config.get_curie_map(),o_count_object_properties_sparql)
     prepare_sparql_count_annotation_properties(o,o_roots,config.get_curie_map(),o_count_annotation_properties_sparql)
     prepare_entities_of_interest(o,o_roots,o_properties,config.get_curie_map(),o_seed_sparql)
+    prepare_seed_terms_query(o,o_roots,o_properties,o_annotation_properties,config.get_curie_map(),o_seed_terms_sparql)
     prepare_ttl_biolink_relations(o,config.get_biolink_relation_map(o),config.get_curie_map(),o_biolink_relations_ttl)
     biolink_annotations_sparqls = prepare_sparql_biolink_annotations(o,config.get_biolink_category_map(o),config.get_curie_map(),o_build_dir)
     
-    print("Downloading {}...".format(o))
-    o_merge_list = download_from_urls(o,config.get_sources(o),o_build_dir,skip)
-    o_merge_list.append(o_role_chains)
-    
-    print("Enriching {} with implied relations...".format(o))
-    if not skip or not os.path.exists(o_enriched):
-        robot_okpk_enrich(o_merge_list,o_materialise_properties,o_enriched,TIMEOUT)
-    if not skip or not os.path.exists(o_count_annotation_properties_csv):
-        robot_query(o_enriched,o_count_annotation_properties_csv,o_count_annotation_properties_sparql,TIMEOUT)
-    if not skip or not os.path.exists(o_count_object_properties_csv):
-        robot_query(o_enriched,o_count_object_properties_csv,o_count_object_properties_sparql,TIMEOUT)
-    
-    print("Filtering {} for classes and relationships of interest...".format(o))
-    if not skip or not os.path.exists(o_reduced):
-        robot_okpk_reduce(o_enriched,o_properties,o_reduced,TIMEOUT)
-    if not skip or not os.path.exists(o_seed):
+    o_sources = get_source_files(o,config.get_sources(o),o_build_dir)
+    # The role chains are only merged in if there are any, so that ontologies built from the same sources share
+    # the enrich step in the step cache
+    o_merge_list = o_sources + ([o_role_chains] if config.get_role_chains(o) else [])
+    o_biolink_categories = os.path.join(o_build_dir,"{}_biolink_categories{}".format(o,o_ext))
+    o_kg_edges_rel_tsv = os.path.join(o_build_dir,"kgx_{}_edges_relations.csv".format(o))
+    o_kg_edges_cl_tsv = os.path.join(o_build_dir,"kgx_{}_edges_cl.csv".format(o))
+    o_kg_nodes_iri_tsv = os.path.join(o_build_dir,"kgx_{}_nodes_iri.csv".format(o))
+    o_kg_edges_rel_iri_tsv = os.path.join(o_build_dir,"kgx_{}_edges_relations_iri.csv".format(o))
+    o_kg_edges_cl_iri_tsv = os.path.join(o_build_dir,"kgx_{}_edges_cl_iri.csv".format(o))
+    o_kg_annotations_iri_tsv = os.path.join(o_build_dir,"kgx_{}_annotations_iri.csv".format(o))
+    o_closure_index = os.path.join(o_build_dir,"closure_{}.pkl".format(o))
+
+    count_queries = [
+        (o_count_annotation_properties_sparql,o_count_annotation_properties_csv,'csv'),
+        (o_count_object_properties_sparql,o_count_object_properties_csv,'csv')]
+    kgx_queries = [
+        (kgx_nodes_sparql,o_kg_nodes_iri_tsv,'csv'),
+        (kgx_edges_sparql,o_kg_edges_rel_iri_tsv,'csv'),
+        (kgx_edges_cl_sparql,o_kg_edges_cl_iri_tsv,'csv'),
+        (kgx_annotations_sparql,o_kg_annotations_iri_tsv,'csv')]
+    # The variable every KGX query is partitioned by in the sharded export
+    kgx_shard_variables = ['iri','subject','subject','id']
+    # Query result, contracted output and the columns holding IRIs to contract
+    kgx_contractions = [
+        (o_kg_nodes_iri_tsv,o_kg_nodes_tsv,['id','category']),
+        (o_kg_edges_rel_iri_tsv,o_kg_edges_rel_tsv,['subject','object','relation','edge_label']),
+        (o_kg_edges_cl_iri_tsv,o_kg_edges_cl_tsv,['subject','object','relation','edge_label']),
+        (o_kg_annotations_iri_tsv,o_kg_annotations_tsv,['id','annotation'])]
+
+    def seed():
         robot_query(o_reduced,o_seed_table,o_seed_sparql,TIMEOUT)
-        prepare_seed_file(o_seed_table,o_annotation_properties,o_seed)
-    if not skip or not os.path.exists(o_finished): 
-        robot_okpk_finish(o_reduced,o_seed,o_finished,TIMEOUT)
-    
-    print("Export {} to obographs (JSON)...".format(o))
-    if not skip or not os.path.exists(o_kg_json): 
-        robot_convert(o_finished,"json",o_kg_json)
-
-    print("Export {} to KGX compliant csv...".format(o))
-    if not skip or not os.path.exists(o_biolink):
-        robot_update(o_enriched,biolink_annotations_sparqls,o_biolink,TIMEOUT)
-        robot_query(o_biolink,o_biolink_category_ttl,construct_kgx_types_sparql,format='ttl',TIMEOUT=TIMEOUT)
-        robot_merge([o_finished,o_biolink_category_ttl,o_biolink_relations_ttl],o_biolink,TIMEOUT)
-    if not skip or not os.path.exists(o_kg_nodes_tsv):
-        robot_query(o_biolink,o_kg_nodes_tsv,kgx_nodes_sparql)
-    if not skip or not os.path.exists(o_kg_edges_tsv):
-        o_kg_edges_rel_tsv = os.path.join(o_build_dir,"kgx_{}_edges_relations.csv".format(o))
-        o_kg_edges_cl_tsv = os.path.join(o_build_dir,"kgx_{}_edges_cl.csv".format(o))
-        robot_query(o_biolink,o_kg_edges_rel_tsv,kgx_edges_sparql)
-        robot_query(o_biolink,o_kg_edges_cl_tsv,kgx_edges_cl_sparql)
-        df_kg_nodes = [pd.read_csv(o_kg_edges_rel_tsv),pd.read_csv(o_kg_edges_cl_tsv)]
-        pd.concat(df_kg_nodes).to_csv(o_kg_edges_tsv)
-    if not skip or not os.path.exists(o_kg_annotations_tsv):
-        robot_query(o_biolink,o_kg_annotations_tsv,kgx_annotations_sparql)
+        prepare_seed_file(o_seed_table,o_annotation_properties,o_seed,config.is_sort_seed())
+
+    def kgx_curies():
+        curie_trie = config.get_curie_trie()
+        for csv_in, csv_out, columns in kgx_contractions:
+            contract_iris_in_csv(csv_in,csv_out,columns,curie_trie)
+
+    def load_closure_index():
+        return okpk_closure_index.load(o_closure_index)
+
+    def closure_counts():
+        index = load_closure_index()
+        index.write_property_counts(o_roots,config.get_curie_map(),o_count_annotation_properties_csv,annotation_properties=True)
+        index.write_property_counts(o_roots,config.get_curie_map(),o_count_object_properties_csv)
+
+    def biolink_categories(ontology_path,categories_path=o_biolink_categories,category_ttl=o_biolink_category_ttl):
+        robot_update(ontology_path,biolink_annotations_sparqls,categories_path,TIMEOUT)
+        robot_query(categories_path,category_ttl,construct_kgx_types_sparql,format='ttl',TIMEOUT=TIMEOUT)
+
+    steps = [
+        okpk_step("download", lambda: download_from_urls(o,config.get_sources(o),o_build_dir,skip,download_cache),
+            outputs=o_sources, params=config.get_sources(o), always_run=True),
+    ]
+    if config.is_fused_pipeline():
+        if config.is_closure_index():
+            print("[{}] closure_index is not used with fused_pipeline, the seed is computed in the ROBOT chain.".format(o))
+        # Without intermediates, biolink categories are assigned on the finished ontology, which keeps the
+        # hierarchy below the roots
+        o_intermediates = [o_enriched,o_reduced] if config.is_keep_intermediates() else []
+        o_categories_source = o_enriched if o_intermediates else o_finished
+        steps.append(okpk_step("enrich_reduce_finish", lambda: robot_okpk_fused(o_merge_list,o_materialise_properties,o_properties,[q[:2] for q in count_queries],o_seed_terms_sparql,o_seed_terms,o_finished,
+                o_enriched if o_intermediates else None,o_reduced if o_intermediates else None,TIMEOUT),
+            inputs=o_merge_list+[q[0] for q in count_queries]+[o_seed_terms_sparql], outputs=[o_finished,o_seed_terms]+[q[1] for q in count_queries]+o_intermediates, params=[o_materialise_properties,o_properties], cacheable=True))
+        steps.append(okpk_step("biolink_categories", lambda: biolink_categories(o_categories_source),
+            inputs=[o_categories_source]+biolink_annotations_sparqls, outputs=[o_biolink_categories,o_biolink_category_ttl]))
+    else:
+        steps.append(okpk_step("enrich", lambda: robot_okpk_enrich(o_merge_list,o_materialise_properties,o_enriched,TIMEOUT),
+            inputs=o_merge_list, outputs=[o_enriched], params=o_materialise_properties, cacheable=True))
+        steps.append(okpk_step("reduce", lambda: robot_okpk_reduce(o_enriched,o_properties,o_reduced,TIMEOUT),
+            inputs=[o_enriched], outputs=[o_reduced], params=o_properties))
+        if config.is_closure_index():
+            steps.append(okpk_step("closure_index", lambda: okpk_closure_index.build(o_enriched).save(o_closure_index),
+                inputs=[o_enriched], outputs=[o_closure_index]))
+            steps.append(okpk_step("count_properties", closure_counts,
+                inputs=[o_closure_index], outputs=[o_count_annotation_properties_csv,o_count_object_properties_csv], params=[o_roots,config.get_curie_map()]))
+            steps.append(okpk_step("seed", lambda: load_closure_index().write_seed(o_roots,o_properties,o_annotation_properties,config.get_curie_map(),o_seed),
+                inputs=[o_closure_index], outputs=[o_seed], params=[o_roots,o_properties,o_annotation_properties,config.get_curie_map()]))
+            steps.append(okpk_step("biolink_categories", lambda: load_closure_index().write_biolink_categories(config.get_biolink_category_map(o),config.get_curie_map(),o_biolink_category_ttl),
+                inputs=[o_closure_index], outputs=[o_biolink_category_ttl], params=[config.get_biolink_category_map(o),config.get_curie_map()]))
+        else:
+            steps.append(okpk_step("count_properties", lambda: robot_query_batch(o_enriched,count_queries,TIMEOUT),
+                inputs=[o_enriched,o_count_annotation_properties_sparql,o_count_object_properties_sparql], outputs=[o_count_annotation_properties_csv,o_count_object_properties_csv]))
+            steps.append(okpk_step("seed", seed,
+                inputs=[o_reduced,o_seed_sparql], outputs=[o_seed_table,o_seed], params=[o_annotation_properties,config.is_sort_seed()]))
+            steps.append(okpk_step("biolink_categories", lambda: biolink_categories(o_enriched),
+                inputs=[o_enriched]+biolink_annotations_sparqls, outputs=[o_biolink_categories,o_biolink_category_ttl]))
+        steps.append(okpk_step("finish", lambda: robot_okpk_finish(o_reduced,o_seed,o_finished,TIMEOUT),
+            inputs=[o_reduced,o_seed], outputs=[o_finished]))
+    steps.append(okpk_step("json", lambda: robot_convert(o_finished,"json",o_kg_json),
+        inputs=[o_finished], outputs=[o_kg_json]))
+    steps.append(okpk_step("biolink", lambda: robot_merge([o_finished,o_biolink_category_ttl,o_biolink_relations_ttl],o_biolink,TIMEOUT),
+        inputs=[o_finished,o_biolink_category_ttl,o_biolink_relations_ttl], outputs=[o_biolink]))
+    if config.get_export_engine() == "native":
+        steps.append(okpk_step("kgx_native", lambda: export_kgx_native(o_biolink,o_kg_nodes_tsv,o_kg_edges_rel_tsv,o_kg_edges_cl_tsv,o_kg_annotations_tsv,config.get_curie_trie()),
+            inputs=[o_biolink], outputs=[c[1] for c in kgx_contractions], params=config.get_curie_map()))
+    else:
+        if config.get_export_shards() > 1:
+            # Every shard runs the KGX queries for a hash partition of the classes in its own ROBOT invocation, and
+            # the shard results are concatenated in shard order
+            o_kgx_shards = prepare_sharded_queries(kgx_queries,kgx_shard_variables,config.get_export_shards(),o_build_dir)
+            for i, shard_queries in enumerate(o_kgx_shards):
+                steps.append(okpk_step("kgx_queries_shard{}".format(i), lambda shard_queries=shard_queries: robot_query_batch(o_biolink,shard_queries,TIMEOUT),
+                    inputs=[o_biolink]+[q[0] for q in shard_queries], outputs=[q[1] for q in shard_queries]))
+
+            def kgx_shards():
+                for i, query in enumerate(kgx_queries):
+                    merge_csv_files([shard_queries[i][1] for shard_queries in o_kgx_shards],query[1])
+
+            steps.append(okpk_step("kgx_shards", kgx_shards,
+                inputs=[q[1] for shard_queries in o_kgx_shards for q in shard_queries], outputs=[q[1] for q in kgx_queries]))
+        else:
+            steps.append(okpk_step("kgx_queries", lambda: robot_query_batch(o_biolink,kgx_queries,TIMEOUT),
+                inputs=[o_biolink]+[q[0] for q in kgx_queries], outputs=[q[1] for q in kgx_queries]))
+        steps.append(okpk_step("kgx_curies", kgx_curies,
+            inputs=[c[0] for c in kgx_contractions], outputs=[c[1] for c in kgx_contractions], params=config.get_curie_map()))
+    steps.append(okpk_step("kgx_edges", lambda: merge_csv_files([o_kg_edges_rel_tsv,o_kg_edges_cl_tsv],o_kg_edges_tsv,config.is_dedupe_edges()),
+        inputs=[o_kg_edges_rel_tsv,o_kg_edges_cl_tsv], outputs=[o_kg_edges_tsv], params=config.is_dedupe_edges()))
+    if config.is_kgx_delta():
+        # Change sets against the previous run, for incremental loads of the knowledge graph
+        o_kg_deltas = [(kind,kgx_file,os.path.join(o_build_dir,"kgx_{}_{}_index.csv".format(o,kind)),
+            [os.path.join(o_ontology_dir,"kgx_{}_{}_{}.csv{}".format(o,kind,change,config.get_output_extension(kind))) for change in ["added","removed","changed"]])
+            for kind, kgx_file in [("nodes",o_kg_nodes_tsv),("edges",o_kg_edges_tsv),("annotations",o_kg_annotations_tsv)]]
+
+        def kgx_delta():
+            for kind, kgx_file, index_file, delta_files in o_kg_deltas:
+                counts = write_kgx_delta(kgx_file,KGX_DELTA_KEYS[kind],index_file,*delta_files)
+                print("[{}] KGX {}: {} added, {} removed, {} changed.".format(o,kind,*counts))
+
+        steps.append(okpk_step("kgx_delta", kgx_delta,
+            inputs=[d[1] for d in o_kg_deltas], outputs=[d[2] for d in o_kg_deltas]+[f for d in o_kg_deltas for f in d[3]], always_run=True))
+    step_workers = plan_ontology_workers(config.get_max_parallel_steps(),worker_java_args,config.get_robot_memory_budget())
+    manifest = okpk_manifest(os.path.join(o_build_dir,"manifest_{}.json".format(o)),robot_version)
+    profiler = okpk_profiler(o) if config.is_run_report() else None
+    label = "[{}]".format(o)
+    o_kgx_outputs = [c[1] for c in kgx_contractions]
+    o_incremental_state = os.path.join(o_build_dir,"incremental_{}.pkl".format(o))
+    o_signature = hashlib.sha256(json.dumps([o_roots,o_properties,o_materialise_properties,o_annotation_properties,
+        config.get_role_chains(o),config.get_biolink_category_map(o),config.get_biolink_relation_map(o),
+        config.get_curie_map(),config.is_dedupe_edges(),robot_version],sort_keys=True).encode('utf-8')).hexdigest()
+
+    def configure_steps(steps):
+        for step in steps:
+            step.timeout = config.get_step_timeout(step.name)
+            step.retries = config.get_step_retries(step.name)
+            step.retry_backoff = config.get_retry_backoff()
+        return steps
 
+    def incremental_steps():
+        """
+        Runs the download and returns the steps that remain: all of them, or only the steps that patch the KGX
+        outputs for the classes affected by the changes since the last run.
+        """
+        run_steps(configure_steps(steps[:1]),1,skip,label,manifest,profiler,step_cache)
+        fingerprint = okpk_source_fingerprint.build(o_sources)
+        affected, reason = plan_incremental_update(o_incremental_state,o_signature,fingerprint,o_kgx_outputs+[o_kg_edges_tsv],config.get_incremental_threshold())
+        if affected is None:
+            print("{} Rebuilding all outputs: {}.".format(label,reason))
+            return steps[1:], fingerprint
+        if not affected:
+            print("{} Sources are semantically unchanged, keeping the previous outputs.".format(label))
+            return [step for step in steps if step.name == "kgx_delta"], fingerprint
+        terms = sorted(affected & fingerprint.classes)
+        print("{} Patching the KGX outputs for {} affected classes.".format(label,len(affected)))
+        o_module_terms = os.path.join(o_build_dir,"module_terms_{}.txt".format(o))
+        o_module = os.path.join(o_build_dir,"{}_module{}".format(o,o_ext))
+        o_module_categories = os.path.join(o_build_dir,"{}_module_categories{}".format(o,o_ext))
+        o_module_category_ttl = os.path.join(o_build_dir,"module_categories_{}.ttl".format(o))
+        o_module_biolink = os.path.join(o_build_dir,"{}_module_biolink{}".format(o,o_ext))
+        o_module_kgx = [os.path.join(o_build_dir,"module_kgx_{}_{}.csv".format(o,t)) for t in ["nodes","edges_relations","edges_cl","annotations"]]
+        write_list_to_file(o_module_terms,terms)
+        patch = []
+        if terms:
+            patch.append(okpk_step("module", lambda: robot_okpk_module(o_merge_list,o_module_terms,o_materialise_properties,o_properties,o_module,TIMEOUT),
+                inputs=o_merge_list+[o_module_terms], outputs=[o_module], params=[o_materialise_properties,o_properties]))
+            patch.append(okpk_step("module_biolink_categories", lambda: biolink_categories(o_module,o_module_categories,o_module_category_ttl),
+                inputs=[o_module]+biolink_annotations_sparqls, outputs=[o_module_categories,o_module_category_ttl]))
+            patch.append(okpk_step("module_biolink", lambda: robot_merge([o_module,o_module_category_ttl,o_biolink_relations_ttl],o_module_biolink,TIMEOUT),
+                inputs=[o_module,o_module_category_ttl,o_biolink_relations_ttl], outputs=[o_module_biolink]))
+            patch.append(okpk_step("module_kgx", lambda: export_kgx_native(o_module_biolink,*o_module_kgx,config.get_curie_trie()),
+                inputs=[o_module_biolink], outputs=o_module_kgx, params=config.get_curie_map()))
+        patch.append(okpk_step("kgx_patch", lambda: patch_kgx_outputs(o_kgx_outputs,o_module_kgx if terms else None,affected,o_roots,config.get_curie_trie()),
+            inputs=o_kgx_outputs+(o_module_kgx if terms else []), outputs=o_kgx_outputs, always_run=True))
+        patch.extend([step for step in steps if step.name in ["kgx_edges","kgx_delta"]])
+        return patch, fingerprint
 
+    try:
+        fingerprint = None
+        if config.is_incremental():
+            steps, fingerprint = incremental_steps()
+        run_steps(configure_steps(steps),step_workers,skip,label,manifest,profiler,step_cache)
+        if fingerprint is not None:
+            save_incremental_state(o_incremental_state,o_signature,fingerprint)
+    finally:
+        if profiler is not None:
+            profiler.save(os.path.join(o_build_dir,"profile_{}.json".format(o)))
 
+run_started = time.time()
+try:
+    run_ontologies_in_parallel(config.get_ontologies(),process_ontology,config.get_max_parallel_ontologies(),worker_java_args,config.get_robot_memory_budget(),config.get_max_parallel_steps())
+finally:
+    if config.is_run_report():
+        print("Run report:")
+        write_run_report([os.path.join(build_dir,o,"profile_{}.json".format(o)) for o in config.get_ontologies()],os.path.join(build_dir,"run_report.json"),os.path.join(build_dir,"run_report.txt"),run_started)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# lib.py is a module at the top of the repository, next to the pipeline script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,132 @@
+"""
+Checks okpk_download_cache against a local HTTP server: full downloads, revalidation with ETags, resumed range
+requests, a stale partial download answered with 416, and offline mode.
+"""
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+import lib
+
+BODY = b"".join(b"line %d of the ontology\n" % i for i in range(1000))
+ETAG = '"v1"'
+
+
+class OntologyHandler(http.server.BaseHTTPRequestHandler):
+    body = BODY
+    etag = ETAG
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.etag)
+            self.end_headers()
+            return
+        start = 0
+        requested = self.headers.get("Range")
+        if requested and self.headers.get("If-Range") == self.etag:
+            start = int(requested[len("bytes="):].rstrip("-"))
+            if start >= len(self.body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(len(self.body)))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(self.body) - 1, len(self.body)))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(self.body) - start))
+        self.end_headers()
+        self.wfile.write(self.body[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    OntologyHandler.requests = []
+    httpd = http.server.HTTPServer(("127.0.0.1", 0), OntologyHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}/hp.owl".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_partial(cache, url, content, etag=ETAG):
+    partial = os.path.join(cache.cache_dir, "partial", cache._url_key(url))
+    with open(partial, "wb") as f:
+        f.write(content)
+    cache._save_partial_metadata(partial, etag, None)
+    return partial
+
+
+def test_download_and_revalidate(server, tmp_path):
+    cache = lib.okpk_download_cache(str(tmp_path / "cache"))
+    blob = cache.fetch(server)
+    assert read(blob) == BODY
+    assert os.path.basename(blob) == hashlib.sha256(BODY).hexdigest()
+    assert OntologyHandler.requests[-1].get("If-None-Match") is None
+
+    # A new run revalidates the cached file, the server answers 304 Not Modified
+    cache = lib.okpk_download_cache(str(tmp_path / "cache"))
+    assert cache.fetch(server) == blob
+    assert OntologyHandler.requests[-1]["If-None-Match"] == ETAG
+    assert len(OntologyHandler.requests) == 2
+
+    # Within a run, a URL is only revalidated once
+    assert cache.fetch(server) == blob
+    assert len(OntologyHandler.requests) == 2
+
+
+def test_resume_partial_download(server, tmp_path):
+    cache = lib.okpk_download_cache(str(tmp_path / "cache"))
+    partial = write_partial(cache, server, BODY[:1000])
+    blob = cache.fetch(server)
+    assert OntologyHandler.requests[-1]["Range"] == "bytes=1000-"
+    assert OntologyHandler.requests[-1]["If-Range"] == ETAG
+    assert read(blob) == BODY
+    assert not os.path.exists(partial)
+
+
+def test_changed_file_restarts_download(server, tmp_path):
+    cache = lib.okpk_download_cache(str(tmp_path / "cache"))
+    # The partial download is of an older version, the server ignores the range and sends the whole file
+    write_partial(cache, server, b"an older version", etag='"v0"')
+    blob = cache.fetch(server)
+    assert len(OntologyHandler.requests) == 1
+    assert read(blob) == BODY
+
+
+def test_stale_partial_download_is_discarded(server, tmp_path):
+    cache = lib.okpk_download_cache(str(tmp_path / "cache"))
+    # The partial file is as long as the whole file, so the range can not be satisfied
+    write_partial(cache, server, BODY)
+    blob = cache.fetch(server)
+    assert [r.get("Range") for r in OntologyHandler.requests] == ["bytes={}-".format(len(BODY)), None]
+    assert read(blob) == BODY
+
+
+def test_offline(server, tmp_path):
+    cache = lib.okpk_download_cache(str(tmp_path / "cache"), offline=True)
+    with pytest.raises(Exception, match="offline mode"):
+        cache.fetch(server)
+    assert OntologyHandler.requests == []
+
+    blob = lib.okpk_download_cache(str(tmp_path / "cache")).fetch(server)
+    cache = lib.okpk_download_cache(str(tmp_path / "cache"), offline=True)
+    assert cache.fetch(server) == blob
+    assert len(OntologyHandler.requests) == 1
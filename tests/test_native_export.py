@@ -0,0 +1,134 @@
+"""
+Checks that export_engine: native writes the same KGX rows as the sparql engine, with the kgx_*.sparql queries
+evaluated by rdflib instead of ROBOT.
+"""
+import csv
+import os
+
+import pytest
+
+import lib
+
+rdflib = pytest.importorskip("rdflib")
+
+SPARQL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sparql")
+
+ONTOLOGY = """<?xml version="1.0"?>
+<rdf:RDF xmlns="http://purl.obolibrary.org/obo/hp.owl#"
+     xml:base="http://purl.obolibrary.org/obo/hp.owl"
+     xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#"
+     xmlns:owl="http://www.w3.org/2002/07/owl#"
+     xmlns:xsd="http://www.w3.org/2001/XMLSchema#"
+     xmlns:obo="http://purl.obolibrary.org/obo/"
+     xmlns:oboInOwl="http://www.geneontology.org/formats/oboInOwl#"
+     xmlns:biolink="https://w3id.org/biolink/vocab/"
+     xmlns:x="http://example.org/x#">
+    <owl:Ontology rdf:about="http://purl.obolibrary.org/obo/hp.owl"/>
+    <owl:AnnotationProperty rdf:about="http://purl.obolibrary.org/obo/IAO_0000115"/>
+    <owl:AnnotationProperty rdf:about="http://www.geneontology.org/formats/oboInOwl#hasExactSynonym"/>
+    <owl:AnnotationProperty rdf:about="http://www.w3.org/2000/01/rdf-schema#comment"/>
+    <owl:AnnotationProperty rdf:about="https://w3id.org/biolink/vocab/category"/>
+    <owl:AnnotationProperty rdf:about="https://w3id.org/biolink/vocab/relation"/>
+    <owl:ObjectProperty rdf:about="http://purl.obolibrary.org/obo/RO_0002200">
+        <rdfs:label>has phenotype</rdfs:label>
+        <biolink:relation rdf:resource="https://w3id.org/biolink/vocab/has_phenotype"/>
+    </owl:ObjectProperty>
+    <owl:Class rdf:about="http://purl.obolibrary.org/obo/HP_0000001">
+        <rdfs:label xml:lang="en">All</rdfs:label>
+        <rdfs:label>All</rdfs:label>
+        <rdfs:comment rdf:parseType="Literal">Root of <x:b>all</x:b> terms</rdfs:comment>
+    </owl:Class>
+    <owl:Class rdf:about="http://purl.obolibrary.org/obo/HP_0000118">
+        <rdfs:subClassOf rdf:resource="http://purl.obolibrary.org/obo/HP_0000001"/>
+        <rdfs:subClassOf>
+            <owl:Restriction>
+                <owl:onProperty rdf:resource="http://purl.obolibrary.org/obo/RO_0002200"/>
+                <owl:someValuesFrom rdf:resource="http://purl.obolibrary.org/obo/UPHENO_0000001"/>
+            </owl:Restriction>
+        </rdfs:subClassOf>
+        <obo:IAO_0000115>A phenotypic abnormality &amp; more.</obo:IAO_0000115>
+        <obo:IAO_0000115 xml:lang="en">A phenotypic abnormality &amp; more.</obo:IAO_0000115>
+        <oboInOwl:hasExactSynonym rdf:datatype="http://www.w3.org/2001/XMLSchema#string">Organ abnormality</oboInOwl:hasExactSynonym>
+        <rdfs:comment rdf:datatype="http://www.w3.org/2001/XMLSchema#integer">1</rdfs:comment>
+        <rdfs:comment>1</rdfs:comment>
+        <rdfs:label xml:lang="en">Phenotypic abnormality</rdfs:label>
+        <biolink:category rdf:resource="https://w3id.org/biolink/vocab/PhenotypicFeature"/>
+    </owl:Class>
+    <owl:Class rdf:about="http://purl.obolibrary.org/obo/UPHENO_0000001">
+        <owl:equivalentClass rdf:resource="http://purl.obolibrary.org/obo/HP_0000118"/>
+        <rdfs:label>affected, état</rdfs:label>
+    </owl:Class>
+    <owl:Class>
+        <owl:intersectionOf rdf:parseType="Collection">
+            <rdf:Description rdf:about="http://purl.obolibrary.org/obo/HP_0000001"/>
+            <rdf:Description rdf:about="http://purl.obolibrary.org/obo/HP_0000118"/>
+        </owl:intersectionOf>
+    </owl:Class>
+</rdf:RDF>
+"""
+
+# Query, output file and the columns contracted to CURIEs, like the kgx_curies step of the pipeline
+QUERIES = [
+    ("kgx_nodes.sparql", "nodes", ["id", "category"]),
+    ("kgx_edges.sparql", "edges_relations", ["subject", "object", "relation", "edge_label"]),
+    ("kgx_edges_cl.sparql", "edges_cl", ["subject", "object", "relation", "edge_label"]),
+    ("kgx_annotations.sparql", "annotations", ["id", "annotation"]),
+]
+
+
+def read_rows(csv_file):
+    with open(csv_file, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        return next(reader), sorted(tuple(row) for row in reader)
+
+
+def write_query_result(graph, query_file, csv_out):
+    """
+    Writes the result of query_file like ROBOT query -f csv: IRIs and the lexical form of literals, and an empty
+    value for unbound variables.
+    """
+    with open(query_file, "r") as f:
+        result = graph.query(f.read())
+    with open(csv_out, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([str(v) for v in result.vars])
+        for row in result:
+            writer.writerow(["" if value is None else str(value) for value in row])
+
+
+def test_native_export_matches_sparql(tmp_path):
+    owl_file = str(tmp_path / "hp_biolink.owl")
+    with open(owl_file, "w", encoding="utf-8") as f:
+        f.write(ONTOLOGY)
+    trie = lib.okpk_curie_trie({"HP": "http://purl.obolibrary.org/obo/HP_", "oio": "http://www.geneontology.org/formats/oboInOwl#"})
+    native = dict((name, str(tmp_path / "native_{}.csv".format(name))) for _, name, _ in QUERIES)
+    lib.export_kgx_native(owl_file, native["nodes"], native["edges_relations"], native["edges_cl"], native["annotations"], trie)
+
+    graph = rdflib.Graph()
+    graph.parse(owl_file, format="xml")
+    for query, name, columns in QUERIES:
+        iri_csv = str(tmp_path / "sparql_{}_iri.csv".format(name))
+        sparql_csv = str(tmp_path / "sparql_{}.csv".format(name))
+        write_query_result(graph, os.path.join(SPARQL_DIR, query), iri_csv)
+        lib.contract_iris_in_csv(iri_csv, sparql_csv, columns, trie)
+        assert read_rows(native[name]) == read_rows(sparql_csv), name
+
+
+def test_literals_keep_language_and_datatype(tmp_path):
+    owl_file = str(tmp_path / "hp_biolink.owl")
+    with open(owl_file, "w", encoding="utf-8") as f:
+        f.write(ONTOLOGY)
+    labels = [(o, literal) for s, p, o, literal in lib.iter_rdfxml_triples(owl_file)
+              if s.endswith("HP_0000001") and p == lib.RDFS_NS + "label"]
+    assert sorted(labels) == [("All", ("", "")), ("All", ("en", ""))]
+
+
+def test_parse_type_literal_is_one_xml_literal(tmp_path):
+    owl_file = str(tmp_path / "hp_biolink.owl")
+    with open(owl_file, "w", encoding="utf-8") as f:
+        f.write(ONTOLOGY)
+    triples = [t for t in lib.iter_rdfxml_triples(owl_file) if t[0].endswith("HP_0000001")]
+    assert not [t for t in triples if t[1].startswith("http://example.org/x#")]
+    comments = [(o, literal) for s, p, o, literal in triples if p == lib.RDFS_NS + "comment"]
+    assert comments == [('Root of <x:b xmlns:x="http://example.org/x#">all</x:b> terms', ("", lib.RDF_NS + "XMLLiteral"))]